@@ -0,0 +1,317 @@
+"""
+Benchmarks ScrapeControl end-to-end against a local mock listing site, offline.
+
+The site serves paginated listings shaped like the BTB REIT demo routine, of configurable
+size and latency. Every scenario runs launch() in its own process on a fresh working folder,
+rows written to csv files, and reports pages/sec, rows/sec, CPU seconds, peak RSS and the
+seconds spent by stage (see "metrics" in README.md).
+
+    python benchmark.py
+    python benchmark.py --pages 200 --listings 50 --latency 20 --scenarios sync lxml processes
+    python benchmark.py --check
+
+Results are appended to benchmarks/results.jsonl with the commit benchmarked, and compared
+with the last run of each scenario on the same site. Values of both parsers ('soup' and 'lxml')
+are checked to be the same first.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# Routine of the BTB REIT demo, values read from every listing of a page
+FUNCTIONS = {
+    "scrape_values": {
+        "containers": {"tag": "div", "type": "class", "sel": "wpsight-listings", "child": {"tag": "div", "type": "class", "sel": "listing"}},
+        "values": {
+            "id_value": "serial",
+            "href": {"tag": "div", "type": "class", "sel": "wpsight-listing-title", "child": {"tag": "h3", "type": "class", "sel": "entry-title", "child": {"tag": "a", "attr": "href"}}},
+            "title": {"tag": "div", "type": "class", "sel": "wpsight-listing-title", "child": {"tag": "h3", "type": "class", "sel": "entry-title", "child": {"tag": "a", "attr": "text"}}},
+            "location": {"tag": "div", "type": "class", "sel": "listing_column_inner", "child": {"tag": "h5", "type": "class", "sel": "listing_location", "attr": "text"}},
+            "sector": {"tag": "div", "type": "class", "sel": "listing_column_inner", "child": {"tag": "h5", "type": "class", "sel": "listing_type", "attr": "text"}}
+        }
+    },
+    "entry_to_db": {
+        "table": "property",
+        "serial": "id",
+        "fields": {"id": ".id_value", "url": ".href", "name": ".title", "location": ".location", "sector": ".sector", "id_company": 1}
+    }
+}
+
+NEXT_PAGE = [{"tag": "ul", "type": "class", "sel": "page-numbers", "child": {"tag": "a", "type": "class", "sel": "next", "attr": "href"}}]
+
+# Page (utf-8 declared only in headers) and selections whose values must be the same with both parsers
+PARITY_PAGE = ('<html><body><div class="listing"><h3 class="entry-title a b">Montréal – Québec</h3>'
+               '<h3 class="a  b">Laval<script>var x = 1;</script><style>h3 {}</style><!-- c --><template>T</template></h3>'
+               '<h3 class=" b ">Lévis</h3><script>var y = 2;</script></div></body></html>').encode('utf-8')
+
+PARITY_SELECTIONS = [
+    {"tag": "h3", "attr": "text"},
+    {"tag": "h3", "type": "class", "sel": "a b", "attr": "text"},
+    {"tag": "h3", "type": "class", "sel": "b", "attr": "class"},
+    {"tag": "h3", "type": "class", "sel": ["entry-title", "a b"], "attr": "text"},
+    {"tag": "div", "type": "class", "sel": "listing", "attr": "text"},
+    {"tag": "div", "child": {"tag": "script", "attr": "text"}}
+]
+
+# Scenarios by name: routine parameters over-ridden, launch engine and number of routines
+SCENARIOS = {
+    'sync': ({}, 'sync', 1),
+    'lxml': ({'parser': 'lxml'}, 'sync', 1),
+    'in_url': ({'in_url': True}, 'sync', 1),
+    'processes': ({'parser': 'lxml', 'in_url': True, 'engine': {'processes': 4}}, 'sync', 1),
+    'async': ({}, 'async', 4),
+    'writer': ({'writer': {'threads': 2}}, 'sync', 1),
+    'archive': ({'parser': 'lxml', 'archive': True, 'engine': {'processes': 4}}, 'sync', 1),
+}
+
+
+def render_page(page, pages, listings, padding):
+    """
+    Returns html of listing page (from 1), linking to next page until the last one.
+    """
+    entries = []
+    for i in range(listings):
+        n = (page - 1) * listings + i
+        entries.append(
+            '<div class="listing"><div class="wpsight-listing-title"><h3 class="entry-title">'
+            '<a href="/property/' + str(n) + '/">Property ' + str(n) + '</a></h3></div>'
+            '<div class="listing_column_inner"><h5 class="listing_location">City ' + str(n % 97) + '</h5>'
+            '<h5 class="listing_type">' + ['Office', 'Retail', 'Industrial'][n % 3] + '</h5></div>'
+            '<p class="listing-excerpt">' + 'x' * padding + '</p></div>'
+        )
+
+    next_link = '<ul class="page-numbers"><li><a class="next" href="?page=' + str(page + 1) + '">Next</a></li></ul>' if page < pages else ''
+    return ('<html><head><title>Portfolio</title></head><body><div class="wpsight-listings">'
+            + ''.join(entries) + '</div>' + next_link + '</body></html>')
+
+
+def start_site(pages, listings, padding, latency):
+    """
+    Starts mock site in a background thread and returns its server. Every path serves
+    listing page "page" of its query, waiting latency milliseconds.
+    """
+    class ListingSite(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            page = int(parse_qs(urlsplit(self.path).query).get('page', ['1'])[0])
+            time.sleep(latency / 1000)
+            body = render_page(page, pages, listings, padding).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ListingSite)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def prepare_folder(folder, scenario, args, port):
+    """
+    Writes settings, routines (and archive of pages) of scenario in working folder.
+    """
+    overrides, engine, routines = SCENARIOS[scenario]
+    os.makedirs(folder + '/scrape')
+
+    # No pacing nor cache, rows to csv files and metrics to json files
+    settings = {
+        'csv': {'path': 'data/'},
+        'limiter': {'rate': 1000000, 'burst': 1000000},
+        'cache': {'policy': 'off'},
+        'metrics': {'summary': False, 'path': 'metrics/', 'format': 'json'}
+    }
+    with open(folder + '/scrape/settings.json', 'w') as f:
+        json.dump(settings, f, indent=4)
+
+    jobs = {}
+    for i in range(routines):
+        parameters = {'path_out': 'out/', 'database': 'csv'}
+        parameters.update({key: value for key, value in overrides.items() if key not in ['in_url', 'archive']})
+        base = 'http://127.0.0.1:' + str(port) + '/site' + str(i) + '/'
+
+        if overrides.get('archive'):
+            parameters['archive'] = {'path': 'archive/', 'url': base}
+            os.makedirs(folder + '/archive', exist_ok=True)
+            for page in range(1, args.pages + 1):
+                with open(folder + '/archive/' + str(page).zfill(8) + '.html', 'w', encoding='utf-8') as f:
+                    f.write(render_page(page, args.pages, args.listings, args.padding))
+        elif overrides.get('in_url'):
+            parameters['url'] = base + '?page=%s'
+            parameters['next_page'] = {'in_url': ['page'], 'start': [1], 'end': [args.pages]}
+        else:
+            parameters['url'] = base + '?page=1'
+            parameters['next_page'] = NEXT_PAGE
+
+        jobs['bench_' + scenario + '_' + str(i)] = {'parameters': parameters, 'functions': FUNCTIONS}
+
+    with open(folder + '/scrape/scrape_bench.json', 'w') as f:
+        json.dump(jobs, f, indent=4)
+    return engine
+
+
+def run_scenario(folder, engine):
+    """
+    Launches routines of working folder in this process and prints its measures as json.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(folder)
+    from scrape_control_requests import ScrapeControl
+
+    with open('scrape/scrape_bench.json') as f:
+        routines = list(json.load(f).keys())
+
+    start, usage = time.perf_counter(), resource.getrusage(resource.RUSAGE_SELF)
+    ScrapeControl().launch(files='scrape_bench.json', routines=routines, engine=engine)
+    elapsed = time.perf_counter() - start
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # Stages and counters summed over routines
+    stages, counters = {}, {}
+    for file_name in os.listdir('metrics'):
+        with open('metrics/' + file_name) as f:
+            report = json.load(f)
+        for name, timer in report['timers'].items():
+            stages[name] = stages.get(name, 0) + timer['seconds']
+        for name, value in report['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+
+    print(json.dumps({
+        'seconds': elapsed,
+        'pages': counters.get('pages', 0),
+        'rows': counters.get('rows', 0),
+        'bytes': counters.get('bytes', 0),
+        'pages_per_sec': counters.get('pages', 0) / elapsed,
+        'rows_per_sec': counters.get('rows', 0) / elapsed,
+        'cpu_seconds': own.ru_utime + own.ru_stime - usage.ru_utime - usage.ru_stime + children.ru_utime + children.ru_stime,
+        'peak_rss_mb': max(own.ru_maxrss, children.ru_maxrss) / 1024,
+        'stages': stages
+    }))
+
+
+def check_parsers():
+    """
+    Asserts every parity selection returns the same values from soup and lxml trees of parity page.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from scrape_control_requests import PageExtraction, Selector
+
+    soup, tree = PageExtraction.parse(PARITY_PAGE, 'soup'), PageExtraction.parse(PARITY_PAGE, 'lxml')
+    for selection in PARITY_SELECTIONS:
+        selector = Selector(selection)
+        assert selector.select(soup) == selector.select(tree), 'Error: parsers differ on ' + json.dumps(selection) + ': ' + repr(selector.select(soup)) + ' ' + repr(selector.select(tree))
+
+
+def get_commit():
+    """
+    Returns commit of repository benchmarked, '' outside of git.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def last_result(results_file, scenario, site):
+    """
+    Returns last stored result of scenario on same site, None if none.
+    """
+    if not os.path.exists(results_file):
+        return None
+
+    last = None
+    with open(results_file) as f:
+        for line in f:
+            result = json.loads(line)
+            if result['scenario'] == scenario and result['site'] == site:
+                last = result
+    return last
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks ScrapeControl against a local mock listing site.')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS.keys()), choices=list(SCENARIOS.keys()))
+    parser.add_argument('--pages', type=int, default=100, help='pages per routine')
+    parser.add_argument('--listings', type=int, default=20, help='listings per page')
+    parser.add_argument('--padding', type=int, default=500, help='characters of text per listing')
+    parser.add_argument('--latency', type=float, default=5, help='milliseconds per response')
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'results.jsonl'))
+    parser.add_argument('--no-store', action='store_true', help="don't store results")
+    parser.add_argument('--check', action='store_true', help='only check both parsers return the same values')
+    parser.add_argument('--run', nargs=2, metavar=('FOLDER', 'ENGINE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process of a scenario
+    if args.run:
+        return run_scenario(*args.run)
+
+    check_parsers()
+    if args.check:
+        print('Parsers: same values')
+        return
+
+    site = {'pages': args.pages, 'listings': args.listings, 'padding': args.padding, 'latency': args.latency}
+    server = start_site(args.pages, args.listings, args.padding, args.latency)
+    commit = get_commit()
+
+    print('Site: ' + ', '.join(key + ' ' + str(value) for key, value in site.items()) + (', commit ' + commit if commit else ''))
+    print('scenario'.ljust(12) + 'pages/s'.rjust(10) + 'rows/s'.rjust(12) + 'cpu s'.rjust(9) + 'rss MB'.rjust(9) + '  vs last')
+
+    for scenario in args.scenarios:
+        folder = tempfile.mkdtemp(prefix='bench_')
+        try:
+            engine = prepare_folder(folder, scenario, args, server.server_port)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', folder, engine], capture_output=True, text=True)
+            assert output.returncode == 0, 'Error: scenario ' + scenario + ' failed\n' + output.stderr
+            measures = json.loads(output.stdout.strip().splitlines()[-1])
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+        # Change of pages/sec since last run of scenario
+        last = last_result(args.results, scenario, site)
+        change = ''
+        if last and last['measures']['pages_per_sec']:
+            change = format(measures['pages_per_sec'] / last['measures']['pages_per_sec'] - 1, '+.1%') + ' (' + (last['commit'] or '?') + ')'
+
+        print(scenario.ljust(12) + format(measures['pages_per_sec'], '10.1f') + format(measures['rows_per_sec'], '12.0f')
+              + format(measures['cpu_seconds'], '9.2f') + format(measures['peak_rss_mb'], '9.1f') + '  ' + change)
+        print('    ' + ', '.join(name + ' ' + format(seconds, '.2f') + 's' for name, seconds in sorted(measures['stages'].items(), key=lambda item: -item[1])[:6]))
+
+        if not args.no_store:
+            os.makedirs(os.path.dirname(args.results), exist_ok=True)
+            with open(args.results, 'a') as f:
+                f.write(json.dumps({
+                    'time': datetime.now().isoformat(timespec='seconds'),
+                    'commit': commit,
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'scenario': scenario,
+                    'site': site,
+                    'measures': measures
+                }) + '\n')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,448 +1,2804 @@
+import asyncio
+import copy
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, Tag, UnicodeDammit
+import lxml.html
+from lxml import etree
 import psycopg2
+from psycopg2.extras import execute_values
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+import csv
+import functools
+import glob
+import gzip
+import hashlib
+import io
+import mmap
+import pickle
+import queue
+import tarfile
 import time
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import islice
+from email.utils import parsedate_to_datetime
+from urllib.parse import unquote, urlsplit
 import json
 import sys
 
-class ScrapeControl:
+
+# Defaults for pooled sessions, over-ridden by "session" in settings.json or in a routine's parameters
+SESSION_DEFAULTS = {
+    'pool_size': 10,
+    'retries': 3,
+    'backoff': 0.5,
+    'keep_alive': True,
+    'timeout': 30
+}
+
+# Defaults for per-host rate limiting, over-ridden by "limiter" in settings.json or in a routine's parameters
+LIMITER_DEFAULTS = {
+    'rate': 0.5,
+    'burst': 1,
+    'max_retries': 5,
+    'backoff': 2,
+    'max_backoff': 120
+}
+
+# Defaults for database writes: rows per transaction (0 for one per page), rows per statement,
+# 'values' (multi-row insert) or 'copy' (COPY FROM STDIN), serials counted from a cached 'max'
+# or drawn from the column's 'sequence' (safe with concurrent writers), and background writer
+# threads (0 to write while scraping) with batches queued for them before scraping waits
+WRITER_DEFAULTS = {
+    'batch_size': 0,
+    'page_size': 1000,
+    'method': 'values',
+    'serial': 'max',
+    'threads': 0,
+    'queue_size': 4
+}
+
+# Defaults for pooled database connections, one pool per database settings shared by routines:
+# connections open at once, seconds idle before a connection is checked when leased, and
+# reconnection attempts with backoff (seconds, doubled every attempt) while the database is unreachable
+POOL_DEFAULTS = {
+    'max_connections': 4,
+    'health_check': 30,
+    'retries': 5,
+    'backoff': 1
+}
+
+# Defaults for file output (database "csv"): folder, 'csv', 'jsonl' or 'parquet', suffix of file names,
+# rows buffered between writes, and rotation by size (bytes, 0 for none) or date (strftime format)
+FILE_DEFAULTS = {
+    'path': 'data/',
+    'format': 'csv',
+    'suffix': '',
+    'buffer_size': 1000,
+    'rotate_size': 0,
+    'rotate_date': ''
+}
+
+# Defaults for the response cache: 'off', 'ttl' (fresh for ttl seconds, then revalidated with
+# ETag/Last-Modified) or 'force' (cached responses always served), folder and max bytes on disk
+CACHE_DEFAULTS = {
+    'policy': 'off',
+    'path': 'cache/',
+    'ttl': 3600,
+    'max_size': 512 * 1024 ** 2
+}
+
+# Defaults for download_entry pages: '', 'gzip' or 'zstd' compression, bytes written per chunk,
+# background workers (0 to download inline), downloads queued at most, downloads at once per host
+# and retries of failed downloads with exponential backoff
+DOWNLOAD_DEFAULTS = {
+    'compression': '',
+    'chunk_size': 64 * 1024,
+    'workers': 4,
+    'queue_size': 100,
+    'host_limit': 2,
+    'retries': 2,
+    'backoff': 1
+}
+
+# Defaults for incremental routines: value of records identifying them, keys seen stored in a 'local'
+# file (under path) or read from the target 'table' (column, key by default), and pagination
+# stopped at the first page entirely seen
+INCREMENTAL_DEFAULTS = {
+    'key': '',
+    'store': 'local',
+    'path': 'state/',
+    'table': '',
+    'column': '',
+    'stop': True
+}
+
+# Defaults for checkpoints: state of the last page whose rows are written, stored under path after
+# every page for an interrupted routine to resume from
+CHECKPOINT_DEFAULTS = {
+    'enabled': True,
+    'path': 'state/'
+}
+
+# Defaults for local archives of pages: directories, glob patterns or tar files under path (str or list),
+# pages picked by suffix and read ahead by window, relative links resolved from url (page's path if empty)
+ARCHIVE_DEFAULTS = {
+    'path': '',
+    'suffixes': ['.html', '.htm', '.html.gz', '.html.zst'],
+    'window': 64,
+    'url': ''
+}
+
+# Defaults for instrumentation: summary printed after every routine, and report written under path
+# as 'json' or 'prometheus' text if a path is given
+METRICS_DEFAULTS = {
+    'summary': True,
+    'path': '',
+    'format': 'json'
+}
+
+# Defaults for the async engine: concurrent fetches within a routine, routines run side by side (at most
+# host_routines per host, on 'threads' or 'processes' of the scheduler) and worker processes parsing
+# pages (0 parses them in the routine's thread)
+ENGINE_DEFAULTS = {
+    'concurrency': 8,
+    'routines': 4,
+    'host_routines': 2,
+    'scheduler': 'threads',
+    'processes': 0
+}
+
+
+def timed(name):
+    """
+    Decorator timing every call of a ScrapeControl method as stage name of its metrics.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Metrics:
+    """
+    Timers and counters of a routine, safe to update from several threads. Timers sum 
+    seconds spent in a stage and its calls (stages can nest), counters sum events or sizes.
+    """
     def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.started = time.perf_counter()
+
+
+    @contextmanager
+    def timer(self, name):
         """
-        Reusable and flexible scraping routines
+        Times block as stage name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
 
-        Execute script with the launch() method ond an ScrapeControl() instance 
-        or from CLI, with or without arguments.
 
-        See README.md for usage.
+    def add_time(self, name, seconds, calls=1):
+        """
+        Adds seconds spent over calls to stage name.
+        """
+        with self.lock:
+            total, count = self.timers.get(name, (0.0, 0))
+            self.timers[name] = (total + seconds, count + calls)
 
+
+    def count(self, name, value=1):
+        """
+        Adds value to counter name.
         """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
 
-        self.path_jobs = 'scrape/'
 
-        # To monitor request load
-        self.last_request = datetime.now()
+    def report(self):
+        """
+        Returns dictionary of seconds elapsed, timers (seconds and calls by stage) and counters.
+        """
+        with self.lock:
+            return {
+                'elapsed': time.perf_counter() - self.started,
+                'timers': {name: {'seconds': total, 'calls': count} for name, (total, count) in self.timers.items()},
+                'counters': dict(self.counters)
+            }
+
 
-        # Load output settings from mandatory file
+    def summary(self, routine_name):
+        """
+        Returns readable summary of report, stages from slowest.
+        """
+        report = self.report()
+        lines = ['Finished: ' + routine_name + ' in ' + format(report['elapsed'], '.2f') + 's, ' + ', '.join(
+            str(value) + ' ' + name for name, value in sorted(report['counters'].items()))]
+        for name, timer in sorted(report['timers'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append('    ' + name.ljust(16) + format(timer['seconds'], '10.3f') + 's ' + str(timer['calls']).rjust(8) + ' calls')
+        return '\n'.join(lines)
+
+
+    def prometheus(self, routine_name):
+        """
+        Returns report in Prometheus text exposition format, labelled by routine.
+        """
+        report = self.report()
+        label = 'routine="' + routine_name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        lines = [
+            '# TYPE scrape_elapsed_seconds gauge',
+            'scrape_elapsed_seconds{' + label + '} ' + repr(report['elapsed']),
+            '# TYPE scrape_stage_seconds_total counter',
+        ]
+        lines += ['scrape_stage_seconds_total{' + label + ',stage="' + name + '"} ' + repr(timer['seconds']) for name, timer in report['timers'].items()]
+        lines.append('# TYPE scrape_stage_calls_total counter')
+        lines += ['scrape_stage_calls_total{' + label + ',stage="' + name + '"} ' + str(timer['calls']) for name, timer in report['timers'].items()]
+        for name, value in report['counters'].items():
+            lines += ['# TYPE scrape_' + name + '_total counter', 'scrape_' + name + '_total{' + label + '} ' + str(value)]
+        return '\n'.join(lines) + '\n'
+
+
+class TokenBucket:
+    """
+    Paces requests to a single host. Holds up to burst tokens, refilled at rate 
+    tokens per second, each request taking one. Thread-safe.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        """
+        Takes a token and returns seconds to wait before sending the request.
+        Tokens can go negative so concurrent callers queue up behind each other.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+
+    def block(self, seconds):
+        """
+        Holds every request to the host for seconds (429 or Retry-After from server).
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class FileSink:
+    """
+    Streams a table's rows to csv, jsonl or parquet files, appending buffered rows. 
+    Files are named after the table and rotated by size or date, columns ordered as fields.
+    """
+    def __init__(self, table, settings):
+        assert settings['format'] in ['csv', 'jsonl', 'parquet'], "Error: file format '" + settings['format'] + "' not 'csv', 'jsonl' or 'parquet'"
+        assert settings['format'] != 'parquet' or pyarrow, "Error: 'pyarrow' is required for parquet output"
+
+        self.table = table
+        self.settings = settings
+        self.path = settings['path'] if settings['path'][-1] in ['/', '\\'] else settings['path'] + '/'
+        self.fields = []
+        self.buffer = []
+
+        # Rows written since last checkpoint, to flush before it's saved
+        self.unsaved = False
+
+        # Held while rows are written or flushed from writer threads
+        self.lock = threading.Lock()
+
+        # Current file, its name without index and rotation index
+        self.file = None
+        self.writer = None
+        self.base = ''
+        self.index = 0
+
+        os.makedirs(self.path, exist_ok=True)
+
+
+    def write(self, fields, rows):
+        """
+        Buffers rows (tuples ordered as fields), written once buffer_size rows are held.
+        """
+        if not self.fields:
+            self.fields = list(fields)
+        assert list(fields) == self.fields, "Error: fields of table '" + self.table + "' changed between rows"
+
+        self.buffer.extend(rows)
+        self.unsaved = self.unsaved or bool(rows)
+        if len(self.buffer) >= self.settings['buffer_size']:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Appends buffered rows to current file.
+        """
+        if not self.buffer:
+            return
+        self.open()
+
+        # Values of string columns written as str, columns typed from their first values
+        if self.settings['format'] == 'parquet':
+            strings = {field.name for field in self.writer.schema if field.type == pyarrow.string()}
+            records = [{field: str(value) if field in strings and value is not None else value for field, value in zip(self.fields, row)} for row in self.buffer]
+            self.writer.write_table(pyarrow.Table.from_pylist(records, schema=self.writer.schema))
+        elif self.settings['format'] == 'jsonl':
+            for row in self.buffer:
+                self.file.write(json.dumps(dict(zip(self.fields, row)), default=str, ensure_ascii=False) + '\n')
+        else:
+            self.writer.writerows(self.buffer)
+
+        self.buffer = []
+
+
+    def open(self):
+        """
+        Opens file for current date, continuing its last file unless full. Parquet files 
+        can't be appended to, every routine starts a new one.
+        """
+        base = self.path + self.table + self.settings['suffix']
+        if self.settings['rotate_date']:
+            base += '_' + datetime.now().strftime(self.settings['rotate_date'])
+        rotate_size = self.settings['rotate_size']
+
+        # Keep current file
+        if self.file and base == self.base and not (rotate_size and self.file.tell() >= rotate_size):
+            return
+        self.close()
+
+        # Find last file of period
+        if base != self.base:
+            self.base, self.index = base, 0
+            while os.path.exists(self.file_name(self.index + 1)):
+                self.index += 1
+
+        # Next file if current is full
+        while os.path.exists(self.file_name(self.index)) and (self.settings['format'] == 'parquet' or rotate_size and os.path.getsize(self.file_name(self.index)) >= rotate_size):
+            self.index += 1
+        file_name = self.file_name(self.index)
+
+        if self.settings['format'] == 'parquet':
+            self.file = open(file_name, 'wb')
+            self.writer = pyarrow.parquet.ParquetWriter(self.file, self.schema())
+        else:
+            new_file = not os.path.exists(file_name) or not os.path.getsize(file_name)
+            self.file = open(file_name, 'a', newline='', encoding='utf-8')
+            if self.settings['format'] == 'csv':
+                self.writer = csv.writer(self.file)
+                if new_file:
+                    self.writer.writerow(self.fields)
+
+
+    def schema(self):
+        """
+        Returns parquet schema of fields, nullable, each typed from its values buffered 
+        (string for columns holding only nulls so far).
+        """
+        columns = []
+        for i, field in enumerate(self.fields):
+            values = [row[i] for row in self.buffer if row[i] is not None]
+            columns.append(pyarrow.field(field, pyarrow.array(values).type if values else pyarrow.string(), nullable=True))
+        return pyarrow.schema(columns)
+
+
+    def file_name(self, index):
+        """
+        Returns name of file for rotation index.
+        """
+        return self.base + ('_' + str(index) if index else '') + '.' + self.settings['format']
+
+
+    def count_rows(self):
+        """
+        Returns count of rows already written for table, over every rotated file.
+        """
+        base = self.path + self.table + self.settings['suffix']
+        extension = '.' + self.settings['format']
+        count = len(self.buffer)
+
+        for file_name in os.listdir(self.path):
+            file_name = self.path + file_name
+            if not (file_name == base + extension or file_name.startswith(base + '_') and file_name.endswith(extension)):
+                continue
+
+            # Csv records may hold newlines, counted by the reader and without header
+            if self.settings['format'] == 'parquet':
+                count += pyarrow.parquet.ParquetFile(file_name).metadata.num_rows
+            elif self.settings['format'] == 'csv':
+                with open(file_name, newline='', encoding='utf-8') as f:
+                    records = sum(1 for _ in csv.reader(f))
+                count += records - 1 if records else 0
+            else:
+                with open(file_name, 'rb') as f:
+                    count += sum(1 for _ in f)
+
+        return count
+
+
+    def close(self):
+        """
+        Closes current file, buffered rows are kept for the next one.
+        """
+        if self.writer and self.settings['format'] == 'parquet':
+            self.writer.close()
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.writer = None
+
+class RowWriter:
+    """
+    Writer stage between extraction and outputs. Batches of rows are queued, submitting 
+    blocks while queue_size batches wait, and written by background threads. A batch is 
+    written once earlier batches of its tables are, so a table's rows land in the order 
+    submitted. Batches are acknowledged in the order submitted, once every earlier batch 
+    is written. A write error stops acknowledgements and is raised on next submit or on join.
+    """
+    def __init__(self, write, ack, settings):
+        self.write = write
+        self.ack = ack
+        self.queue = queue.Queue(settings['queue_size'])
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+        # Batches submitted, position of last one by table, written but waiting on earlier ones by position, and acknowledged
+        self.submitted = 0
+        self.last = {}
+        self.written = {}
+        self.acked = 0
+        self.error = None
+
+        self.threads = [threading.Thread(target=self.run, daemon=True) for i in range(settings['threads'])]
+        for thread in self.threads:
+            thread.start()
+
+
+    def submit(self, rows, *state):
+        """
+        Queues batch of rows (by (db_type, table, fields)) with state passed to ack once written.
+        """
+        if self.error:
+            raise self.error
+
+        # Batch written after last batch of each of its tables
+        tables = {(db_type, table) for db_type, table, fields in rows.keys()}
+        with self.lock:
+            after = {self.last[table] for table in tables if table in self.last}
+            for table in tables:
+                self.last[table] = self.submitted
+            position = self.submitted
+            self.submitted += 1
+        self.queue.put((position, rows, state, after))
+
+
+    def run(self):
+        """
+        Writes queued batches until stopped. Runs in a writer thread.
+        """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            position, rows, state, after = job
+
+            # Wait for earlier batches of same tables, taken from queue before by other threads
+            with self.changed:
+                self.changed.wait_for(lambda: self.error or all(earlier < self.acked or earlier in self.written for earlier in after))
+
+            try:
+                if not self.error:
+                    self.write(rows)
+            except Exception as err:
+                self.error = self.error or err
+
+            # Acknowledge every batch written without gap since last acknowledged
+            with self.lock:
+                self.written[position] = (rows, state)
+                while not self.error and self.acked in self.written:
+                    rows, state = self.written.pop(self.acked)
+                    try:
+                        self.ack(rows, *state)
+                    except Exception as err:
+                        self.error = err
+                    self.acked += 1
+                self.changed.notify_all()
+
+
+    def join(self):
+        """
+        Waits for queued batches to be written and acknowledged, stops threads and raises write error if any.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error:
+            raise self.error
+
+
+class ConnectionPool:
+    """
+    Pool of connections to a PostgreSQL database, shared by routines with the same settings. 
+    Leasing waits while max_connections are out, connections idle for health_check seconds 
+    are checked first, and an unreachable database is retried with backoff. Thread-safe.
+    """
+    def __init__(self, db_settings, settings):
+        self.settings = settings
+        self.db_settings = {key: value for key, value in db_settings.items() if key in ['host', 'port', 'database', 'user', 'password']}
+        self.slots = threading.Semaphore(settings['max_connections'])
+        self.lock = threading.Lock()
+
+        # Connections returned, with time they were
+        self.idle = []
+
+
+    def lease(self):
+        """
+        Returns a live connection, waiting for one to be returned if all are leased.
+        """
+        self.slots.acquire()
         try:
-            with open(self.path_jobs + "settings.json", "r") as f:
-                self.db_settings = json.load(f)
-        except FileNotFoundError:
-            assert False, 'Error: file not found "settings.json".'
-        
+            return self.connect()
+        except Exception:
+            self.slots.release()
+            raise
 
-    def launch(self, files='', routines='', argv='', demo=False):
+
+    def connect(self):
         """
-        Method will execute requested routines, can be called from CLI as well.
-        Calling it without any files, routines or CLI arguments will execute 
-        every routine in every "scrape_settings_*.json" file.
+        Returns a pooled connection passing its health check, or a new one. Retries with 
+        backoff while the database is unreachable, raises its error after the last retry.
         """
+        # Most recently returned connections first, dead ones dropped
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, returned = self.idle.pop()
+            if self.alive(conn, returned):
+                return conn
+            conn.close()
+
+        attempt = 0
+        while True:
+            try:
+                return psycopg2.connect(**self.db_settings)
+            except psycopg2.OperationalError as err:
+                if attempt == self.settings['retries']:
+                    raise
+                delay = self.settings['backoff'] * 2 ** attempt
+                print("Couldn't connect to database, retrying in " + str(delay) + 's: ' + str(err).strip())
+                time.sleep(delay)
+                attempt += 1
 
-        # Stores files/routines from CLI arguments in lists
-        if argv[1:]:
-            self.check_argv(sys.argv)
 
-        # Stores files/routines from method arguments in lists
-        elif files and routines:
-            if isinstance(files, str):
-                self.scrape_files = [files]
-            elif isinstance(files, list):
-                self.scrape_files = files
+    def alive(self, conn, returned):
+        """
+        Returns if connection is open, queried when idle for health_check seconds.
+        """
+        if conn.closed:
+            return False
+        if time.monotonic() - returned < self.settings['health_check']:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
 
-            if isinstance(routines, str):
-                self.scrape_routines = [routines]
-            elif isinstance(routines, list):
-                self.scrape_routines = routines
 
-        # Stores files/routines as empty lists, selecting every files/routines
+    def release(self, conn):
+        """
+        Returns connection to pool, its open transaction rolled back. Closed connections are dropped.
+        """
+        try:
+            if not conn.closed:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+        if not conn.closed:
+            with self.lock:
+                self.idle.append((conn, time.monotonic()))
+        self.slots.release()
+
+
+    def close(self):
+        """
+        Closes idle connections of the pool.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, returned in idle:
+            conn.close()
+
+
+class DownloadQueue:
+    """
+    Bounded queue of page downloads run in background by a thread pool. Submitting 
+    blocks while queue_size downloads are pending, each host gets host_limit downloads 
+    at once, failed downloads are retried with backoff and reported when joined.
+    """
+    def __init__(self, download, settings):
+        self.download = download
+        self.settings = settings
+        self.pool = ThreadPoolExecutor(settings['workers'])
+        self.slots = threading.Semaphore(settings['queue_size'])
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+        # Downloads not done yet, and report
+        self.pending = {}
+        self.done = 0
+        self.failed = []
+
+
+    def submit(self, url, file_name):
+        """
+        Queues download of url to file_name, waiting for a slot if queue is full.
+        """
+        self.slots.acquire()
+        with self.lock:
+            host = urlsplit(url).netloc
+            if host not in self.hosts:
+                self.hosts[host] = threading.Semaphore(self.settings['host_limit'])
+            future = self.pool.submit(self.run, url, file_name, self.hosts[host])
+            self.pending[future] = (url, file_name)
+        future.add_done_callback(self.drop)
+
+
+    def drop(self, future):
+        """
+        Forgets download once done, pending holding only downloads in flight.
+        """
+        with self.lock:
+            self.pending.pop(future, None)
+
+
+    def run(self, url, file_name, host_slots):
+        """
+        Downloads url, retrying on errors. Runs in a worker thread.
+        """
+        try:
+            for attempt in range(self.settings['retries'] + 1):
+                try:
+                    with host_slots:
+                        self.download(url, file_name)
+                    with self.lock:
+                        self.done += 1
+                    return
+
+                except Exception as err:
+                    if attempt == self.settings['retries']:
+                        with self.lock:
+                            self.failed.append((url, repr(err)))
+                    else:
+                        time.sleep(self.settings['backoff'] * 2 ** attempt)
+        finally:
+            self.slots.release()
+
+
+    def join(self):
+        """
+        Waits for every queued download, stops workers and returns report 
+        (dict of count done and list of failed (url, error)).
+        """
+        self.pool.shutdown(wait=True)
+        self.pending = {}
+        return {'done': self.done, 'failed': self.failed}
+
+
+    def pending_downloads(self):
+        """
+        Returns (url, file_name) of downloads not done yet.
+        """
+        with self.lock:
+            return list(self.pending.values())
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of responses on disk, keyed by method, url and payload. 
+    Entries are a body file and a json file of metadata (validators, time stored). 
+    Least recently used entries are evicted once over max_size bytes. Thread-safe.
+    """
+    def __init__(self, path, max_size):
+        self.path = path if path[-1] in ['/', '\\'] else path + '/'
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+
+    @staticmethod
+    def key(type_req, url, payload=''):
+        """
+        Returns key of request.
+        """
+        request = json.dumps([type_req.lower(), url, payload], sort_keys=True, default=str)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+
+    def get(self, key):
+        """
+        Returns (metadata, content) of cached response or None, marking it recently used.
+        """
+        file_name = self.path + key
+        try:
+            with open(file_name + '.json', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(file_name + '.body', 'rb') as f:
+                content = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+
+        os.utime(file_name + '.body')
+        return meta, content
+
+
+    def put(self, key, url, response):
+        """
+        Stores response with its validators, then evicts old entries if cache is full.
+        """
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag', ''),
+            'last_modified': response.headers.get('Last-Modified', ''),
+            'content_type': response.headers.get('Content-Type', ''),
+            'stored': time.time()
+        }
+        file_name = self.path + key
+
+        # Write atomically, concurrent readers see whole entries only
+        for extension, data in [('.body', response.content), ('.json', json.dumps(meta).encode('utf-8'))]:
+            temp_name = file_name + extension + '.' + str(threading.get_ident()) + '.tmp'
+            with open(temp_name, 'wb') as f:
+                f.write(data)
+            os.replace(temp_name, file_name + extension)
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.name.endswith('.body'))
+            else:
+                self.size += len(response.content)
+
+            if self.size > self.max_size:
+                self.evict()
+
+
+    def refresh(self, key, meta):
+        """
+        Restarts freshness of entry revalidated by the server (304).
+        """
+        meta['stored'] = time.time()
+        temp_name = self.path + key + '.json.' + str(threading.get_ident()) + '.tmp'
+        with open(temp_name, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temp_name, self.path + key + '.json')
+
+
+    def evict(self):
+        """
+        Deletes least recently used entries until cache holds 90% of max_size. Called with lock.
+        """
+        entries = sorted(
+            [entry for entry in os.scandir(self.path) if entry.name.endswith('.body')],
+            key=lambda entry: entry.stat().st_mtime
+        )
+        self.size = sum(entry.stat().st_size for entry in entries)
+
+        for entry in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            self.size -= entry.stat().st_size
+            for extension in ['.body', '.json']:
+                try:
+                    os.remove(entry.path[:-len('.body')] + extension)
+                except FileNotFoundError:
+                    pass
+
+
+class FrozenDict(dict):
+    """
+    Dictionary of a compiled routine, read-only so runs can't alter it.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Error: routine's dictionaries are read-only")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+class FrozenList(list):
+    """
+    List of a compiled routine, read-only so runs can't alter it.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Error: routine's lists are read-only")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = remove = pop = clear = sort = reverse = _read_only
+
+    def __reduce__(self):
+        return FrozenList, (list(self),)
+
+
+def freeze(value):
+    """
+    Returns copy of value with its dictionaries and lists made read-only.
+    """
+    if isinstance(value, dict):
+        return FrozenDict({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return FrozenList([freeze(item) for item in value])
+    return value
+
+
+class Compiled:
+    """
+    Base of compiled routine objects, attributes set once on creation.
+    """
+    __slots__ = ()
+
+    def __init__(self, **attributes):
+        for name, value in attributes.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Error: compiled " + type(self).__name__ + " is immutable")
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
+class Selector(Compiled):
+    """
+    Selection dictionary compiled once into steps of (tag, attributes, index, xpath). Every 
+    step but the last descends into the first element found, the last one returns the value 
+    of every element found, processed by attr, slice and date_type. Steps search soups with 
+    find_all and lxml trees with their compiled XPath, returning the same values.
+    """
+    # Attributes holding space-separated values, matched by any of them as BeautifulSoup does
+    multi_valued = ['class', 'rel', 'rev', 'accept-charset', 'headers', 'accesskey', 'dropzone']
+
+    # Elements whose text BeautifulSoup leaves out of their parent's text
+    hidden_text = ['script', 'style', 'template']
+
+    # Compiled XPaths by expression, kept per thread
+    xpaths = threading.local()
+
+    __slots__ = ('steps', 'attr', 'slice', 'date_type')
+
+    def __init__(self, element_dic):
+        steps = []
+
+        # Flatten nested 'child' dictionaries into steps
+        while True:
+            assert 'tag' in element_dic.keys() or 'attr' in element_dic.keys(), "Error: Mandatory 'tag' not found in 'get_elements()'s dic."
+
+            index = element_dic.get('index')
+            if index is not None:
+                assert isinstance(index, int) or isinstance(index, list), "Error: index not int or list not found in 'get_elements()'s dic."
+                assert isinstance(index, int) or len(index) == 2, "Error: index list not with 2 values [min, max]."
+
+            # Attribute selector only applies with a tag
+            attrs = {}
+            if 'tag' in element_dic.keys() and 'type' in element_dic.keys() and 'sel' in element_dic.keys():
+                attrs = {element_dic['type']: element_dic['sel']}
+
+            tag = element_dic.get('tag')
+            xpath = self.compile_xpath(tag, attrs) if tag else None
+            steps.append((tag, attrs, index, xpath))
+
+            if 'child' not in element_dic.keys():
+                break
+            element_dic = element_dic['child']
+
+        # Processing of values on last step
+        super().__init__(steps=tuple(steps), attr=element_dic.get('attr'), slice=element_dic.get('slice'), date_type=element_dic.get('date_type'))
+
+
+    @classmethod
+    def compile_xpath(cls, tag, attrs):
+        """
+        Returns XPath expression of descendants with tag and attributes, and the selected 
+        values bound to its variables. Kept as plain data so selectors can be pickled.
+        """
+        path = './/' + tag
+        variables = {}
+
+        for name, values in attrs.items():
+            values = values if isinstance(values, list) else [values]
+            tests = []
+            for value in values:
+                variable = 'v' + str(len(variables))
+                variables[variable] = str(value)
+
+                # Whole value, or one of space-separated values unless value holds spaces
+                if name in cls.multi_valued and any(char.isspace() for char in str(value)):
+                    tests.append("normalize-space(@" + name + ")=$" + variable)
+                elif name in cls.multi_valued:
+                    variables[variable + 's'] = ' ' + str(value) + ' '
+                    tests.append("normalize-space(@" + name + ")=$" + variable + " or contains(concat(' ', normalize-space(@" + name + "), ' '), $" + variable + "s)")
+                else:
+                    tests.append("@" + name + "=$" + variable)
+            path += '[' + ' or '.join(tests) + ']'
+
+        return path, variables
+
+
+    @classmethod
+    def evaluate(cls, tree, xpath):
+        """
+        Returns elements of (expression, variables) xpath within tree, compiled on first use.
+        """
+        path, variables = xpath
+        if path not in cls.xpaths.__dict__:
+            cls.xpaths.__dict__[path] = etree.XPath(path)
+        return cls.xpaths.__dict__[path](tree, **variables)
+
+
+    def select(self, soup):
+        """
+        Returns list of elements or values found within soup or lxml tree.
+        """
+        for step in self.steps[:-1]:
+            tags = self.find(soup, step)
+            if not tags:
+                return []
+            soup = tags[0]
+
+        return [self.value(tag) for tag in self.find(soup, self.steps[-1])]
+
+
+    @staticmethod
+    def find(soup, step):
+        """
+        Returns elements of a step, soup itself if no tag, sliced by index.
+        """
+        tag, attrs, index, xpath = step
+
+        if not tag:
+            tags = [soup]
+        elif etree.iselement(soup):
+            tags = Selector.evaluate(soup, xpath)
         else:
-            self.scrape_files = [f for f in os.listdir('scrape') if 'scrape_' in f]
-            if not demo:
-                self.scrape_files = [f for f in self.scrape_files if '_demo' not in f]
-            self.scrape_routines = []
+            tags = soup.find_all(tag, attrs)
+
+        if isinstance(index, int):
+            tags = [tags[index]]
+        elif index:
+            tags = tags[index[0]:index[1]]
+
+        return tags
+
+
+    @classmethod
+    def text(cls, tag):
+        """
+        Returns text of lxml element as BeautifulSoup does, without text of its scripts, styles and templates.
+        """
+        if tag.tag in cls.hidden_text:
+            return str(tag.text_content())
+        hidden = ' or '.join('ancestor::' + name for name in cls.hidden_text)
+        return ''.join(cls.evaluate(tag, ('.//text()[not(' + hidden + ')]', {})))
+
+
+    def value(self, tag):
+        """
+        Returns text or attribute of element if requested, sliced and parsed as date if requested.
+        """
+        if self.attr == 'text':
+            result = self.text(tag) if etree.iselement(tag) else tag.text
+        elif self.attr and etree.iselement(tag):
+            result = tag.attrib[self.attr]
+            if self.attr in self.multi_valued:
+                result = result.split()
+        elif self.attr:
+            result = tag[self.attr]
+        else:
+            result = tag
+
+        # Return result (if str) sliced
+        if self.slice:
+            assert isinstance(result, str), 'Error: Tried to slice non-str'
+            result = result[self.slice[0]:self.slice[1]]
+
+        # Returns result re-interpreted by 'date_type' format string
+        if self.date_type:
+            assert isinstance(result, str), "Error: date to parse is '" + str(type(result)) + "' not str."
+            result = datetime.strptime(result.strip(), self.date_type)
+
+        return result
+
+
+class ValueTrie(Compiled):
+    """
+    Values of scrape_values compiled into a trie of their selectors' steps. Steps shared 
+    by several values are searched once per container, values sharing their last step 
+    are all read from the same elements.
+    """
+    __slots__ = ('names', 'serials', 'root')
+
+    def __init__(self, values_dic):
+        root = {'children': {}, 'leaves': {}}
+
+        for name, element_dic in values_dic.items():
+            if element_dic == 'serial':
+                continue
+            assert isinstance(element_dic, dict), "Error: " + str(type(element_dic)) + " provided to 'scrape_values()' instead of dict"
+            selector = Selector(element_dic)
+
+            # Descend steps, adding missing nodes
+            node = root
+            for step in selector.steps[:-1]:
+                node = node['children'].setdefault(self.key(step), {'step': step, 'children': {}, 'leaves': {}})
+
+            leaf = node['leaves'].setdefault(self.key(selector.steps[-1]), {'step': selector.steps[-1], 'values': []})
+            leaf['values'].append((name, selector))
+
+        super().__init__(
+            names=tuple(values_dic.keys()),
+            serials=tuple(name for name, element_dic in values_dic.items() if element_dic == 'serial'),
+            root=freeze(root)
+        )
+
+
+    @staticmethod
+    def key(step):
+        """
+        Returns hashable key of step.
+        """
+        return json.dumps(step[:3], sort_keys=True)
+
+
+    def extract(self, container, container_i):
+        """
+        Returns dictionary of every value found in container, single results out of their list.
+        """
+        row = {name: [] for name in self.names}
+        for name in self.serials:
+            row[name] = container_i
+
+        self.walk(self.root, container, row)
+
+        for name, value in row.items():
+            if isinstance(value, list) and len(value) == 1: #//TODO check ==1
+                row[name] = value[0]
+
+        return row
+
+
+    def walk(self, node, element, row):
+        """
+        Stores values of node's leaves found in element, then walks children from their first element.
+        """
+        for leaf in node['leaves'].values():
+            tags = Selector.find(element, leaf['step'])
+            for name, selector in leaf['values']:
+                row[name] = [selector.value(tag) for tag in tags]
+
+        for child in node['children'].values():
+            tags = Selector.find(element, child['step'])
+            if tags:
+                self.walk(child, tags[0], row)
+
+
+class PageArchive:
+    """
+    Pages saved locally, enumerated lazily from directories (walked in name order), glob 
+    patterns or tar files. Files are read by memory map and decompressed by suffix.
+    """
+    def __init__(self, paths, suffixes):
+        self.paths = paths if isinstance(paths, list) else [paths]
+        self.suffixes = tuple(suffixes)
+
+
+    def __iter__(self):
+        """
+        Yields (name, file_name, content) of every page, content only for tar members 
+        and file_name only for files, left to be read by whoever parses them.
+        """
+        for path in self.paths:
+            assert path, "Error: empty path for archive"
+            if os.path.isdir(path):
+                yield from self.iter_directory(path)
+            elif os.path.isfile(path) and tarfile.is_tarfile(path):
+                yield from self.iter_tar(path)
+            elif os.path.isfile(path):
+                yield path, path, None
+            else:
+                for file_name in glob.iglob(path, recursive=True):
+                    if os.path.isdir(file_name):
+                        yield from self.iter_directory(file_name)
+                    elif file_name.endswith(self.suffixes):
+                        yield file_name, file_name, None
+
+
+    def iter_directory(self, path):
+        """
+        Yields pages of directory and its sub-directories.
+        """
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(self.suffixes):
+                    yield os.path.join(root, name), os.path.join(root, name), None
+
+
+    def iter_tar(self, path):
+        """
+        Yields pages of tar file (compressed or not), read as a stream.
+        """
+        with tarfile.open(path, 'r|*') as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith(self.suffixes):
+                    yield path + '/' + member.name, None, self.decode(member.name, tar.extractfile(member).read())
+
+
+    @classmethod
+    def read(cls, file_name):
+        """
+        Returns text of local page, mapped in memory rather than read through buffers.
+        """
+        with open(file_name, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return ''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return cls.decode(file_name, mapped)
+
+
+    @staticmethod
+    def decode(name, content):
+        """
+        Returns content decompressed by name's suffix (.gz, .zst) and decoded as utf-8 as local pages are.
+        """
+        if name.endswith('.gz'):
+            content = gzip.decompress(content)
+        elif name.endswith('.zst'):
+            assert zstandard, "Error: 'zstandard' is required for zstd pages"
+            content = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(content)).read()
+        return str(content, 'utf-8')
+
+
+class PageExtraction:
+    """
+    Selections of a routine compiled once and run on page contents by worker processes. 
+    Pages are parsed and searched in the worker and only values found are sent back, 
+    elements selected as such are sent as their markup.
+    """
+    def __init__(self, parser, element_dics, values_dics):
+        self.parser = parser
+        self.selectors = {self.key(dic): Selector(dic) for dic in element_dics}
+        self.values = {self.key(dic): (Selector(dic['containers']), ValueTrie(dic['values'])) for dic in values_dics}
+
+
+    @staticmethod
+    def key(dic):
+        """
+        Returns key of selection dictionary, same in every process.
+        """
+        return json.dumps(dic, sort_keys=True, default=str)
+
+
+    @staticmethod
+    def parse(content, parser):
+        """
+        Returns page parsed by parser: BeautifulSoup ('soup') or raw lxml.html tree ('lxml').
+        """
+        if parser == 'soup':
+            return BeautifulSoup(content, 'lxml')
+
+        # Bytes decoded as BeautifulSoup does (encoding declared by page, else sniffed) instead 
+        # of lxml's latin-1 default, text parsed as utf-8
+        if isinstance(content, bytes):
+            content = UnicodeDammit(content, is_html=True).unicode_markup or ''
+        content = content.encode('utf-8')
+
+        if not content.strip():
+            content = b'<html></html>'
+        return lxml.html.document_fromstring(content, parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+
+    def __call__(self, content, file_name=''):
+        """
+        Returns PageValues of content, or of local file read by worker, values of 
+        scrape_values by container as it stores them.
+        """
+        start = time.perf_counter()
+        page = self.parse(PageArchive.read(file_name) if file_name else content, self.parser)
+        parsed = time.perf_counter()
+        elements = {key: self.plain(selector.select(page)) for key, selector in self.selectors.items()}
+
+        values = {}
+        for key, (containers, trie) in self.values.items():
+            found = containers.select(page)
+            assert found, 'Error: no containers'
+            values[key] = {container_i: self.plain(trie.extract(container, container_i)) for container_i, container in enumerate(found)}
+
+        return PageValues(elements, values, {'parse': parsed - start, 'extract': time.perf_counter() - parsed})
+
+
+    @classmethod
+    def plain(cls, value):
+        """
+        Returns value with elements replaced by their markup, to be sent between processes.
+        """
+        if isinstance(value, list):
+            return [cls.plain(item) for item in value]
+        if isinstance(value, dict):
+            return {key: cls.plain(item) for key, item in value.items()}
+        if etree.iselement(value):
+            return lxml.html.tostring(value, encoding='unicode')
+        if isinstance(value, Tag):
+            return str(value)
+        return value
+
+
+class PageValues:
+    """
+    Values found on a page by a worker process, searched in place of its soup, 
+    with seconds the worker spent by stage.
+    """
+    def __init__(self, elements, values, timings):
+        self.elements = elements
+        self.values = values
+        self.timings = timings
+
+
+class Pagination(Compiled):
+    """
+    Pagination of a routine, of kind 'link' (urls selected by 'next_page' dictionaries, after 
+    bouncing on 'first_page'), 'in_url' (range planned in url), 'payload' (post payload's 
+    page incremented up to 'max') or '' (first page only).
+    """
+    __slots__ = ('kind', 'first_page', 'links', 'in_url', 'payload', 'max', 'selectors')
+
+    def __init__(self, parameters, request_type):
+        next_page = parameters.get('next_page')
+        first_page = parameters.get('first_page')
+        links, in_url, payload, maximum = (), None, '', None
+
+        if not next_page:
+            kind = ''
+
+        elif isinstance(next_page, dict) and 'in_url' in next_page.keys():
+            kind = 'in_url'
+            assert 'start' in next_page.keys() and 'end' in next_page.keys(), "Error: 'in_url' without 'start' and 'end'"
+            assert len(next_page['in_url']) == len(next_page['start']) == len(next_page['end']), "Error: 'in_url', 'start' and 'end' not of same length"
+            in_url = next_page
+
+        elif request_type == 'post':
+            kind = 'payload'
+            assert 'payload' in next_page.keys() and 'max' in next_page.keys(), "Error: post 'next_page' without 'payload' and 'max'"
+            assert next_page['payload'] in parameters['payload'].keys(), "Error: '" + next_page['payload'] + "' not in payload"
+            payload, maximum = next_page['payload'], next_page['max']
+
+        else:
+            kind = 'link'
+            links = tuple(next_page if isinstance(next_page, list) else [next_page])
+
+        # Selection dictionaries with their compiled selector
+        selectors = tuple((element_dic, Selector(element_dic)) for element_dic in ([first_page] if first_page else []) + list(links))
+
+        super().__init__(kind=kind, first_page=first_page, links=links, in_url=in_url, payload=payload, max=maximum, selectors=selectors)
+
+
+class Routine(Compiled):
+    """
+    Routine of a scrape file compiled once: parameters validated and frozen, urls, functions 
+    and pagination normalized, selection dictionaries of scrape_values and pagination compiled 
+    along them ((dictionary, compiler, compiled) in selectors). Immutable, so a run never alters 
+    it for the next one, and picklable to be cached.
+    """
+    __slots__ = ('name', 'parameters', 'functions', 'urls', 'request_type', 'pagination', 'path_out', 'priority', 'after', 'host', 'serial_tables', 'selectors')
+
+    def __init__(self, name, routine):
+        assert isinstance(routine, dict) and isinstance(routine.get('parameters'), dict), "Error: parameters dict not found in routine '" + name + "'."
+        assert isinstance(routine.get('functions', {}), dict), "Error: functions of routine '" + name + "' not dict"
+        parameters = freeze(routine['parameters'])
+
+        # Verify inputs in parameters
+        assert 'url' in parameters.keys() or 'archive' in parameters.keys(), "Error: 'url' or 'archive' not found in dict's parameters."
+        assert parameters.get('parser', 'soup') in ['soup', 'lxml'], "Error: parser not 'soup' or 'lxml'"
+        request_type = parameters.get('request', 'get')
+        assert request_type in ['get', 'post'], "Error: request '" + str(request_type) + "' not 'get' or 'post'"
+        assert request_type == 'get' or isinstance(parameters.get('payload'), dict), 'Error: no payload for post request'
+
+        # Urls as tuple, archives are read once and name their pages
+        if 'archive' in parameters.keys():
+            urls = ('',)
+        elif isinstance(parameters['url'], list):
+            urls = tuple(parameters['url'])
+        else:
+            urls = (parameters['url'],)
+        assert urls and all(isinstance(url, str) for url in urls), "Error: no url or non-str url"
+
+        # Path for downloaded pages, with its trailing slash
+        path_out = parameters.get('path_out', '')
+        if path_out and path_out[-1] not in ['/', '\\']:
+            path_out += '/'
+
+        # To support repetition of function, names hold a unique digit
+        functions, selectors = [], []
+        for fc_name, fc_args in routine.get('functions', {}).items():
+            fc = ''.join([c for c in fc_name if not c.isnumeric()])
+            fc_args = freeze(fc_args)
+            if fc == 'scrape_values':
+                assert isinstance(fc_args, dict) and 'containers' in fc_args.keys() and 'values' in fc_args.keys(), "Error: 'scrape_values' without 'containers' and 'values'"
+                selectors.append((fc_args['containers'], Selector, Selector(fc_args['containers'])))
+                selectors.append((fc_args['values'], ValueTrie, ValueTrie(fc_args['values'])))
+            elif fc == 'entry_to_db':
+                assert isinstance(fc_args, dict) and 'table' in fc_args.keys() and 'fields' in fc_args.keys(), "Error: 'entry_to_db' without 'table' and 'fields'"
+                upsert = fc_args.get('upsert', [])
+                assert all(field in fc_args['fields'].keys() for field in ([upsert] if isinstance(upsert, str) else upsert)), "Error: 'upsert' keys not in 'fields'"
+            functions.append((fc, fc_args))
+
+        pagination = Pagination(parameters, request_type)
+        selectors.extend((element_dic, Selector, selector) for element_dic, selector in pagination.selectors)
+
+        after = parameters.get('after', [])
+        host = urlsplit(urls[0]).netloc if 'archive' not in parameters.keys() else ''
+
+        super().__init__(
+            name=name,
+            parameters=parameters,
+            functions=tuple(functions),
+            urls=urls,
+            request_type=request_type,
+            pagination=pagination,
+            path_out=path_out,
+            priority=parameters.get('priority', 0),
+            after=tuple([after] if isinstance(after, str) else after),
+            host=host,
+            serial_tables=frozenset(fc_args['table'] for fc, fc_args in functions if fc == 'entry_to_db' and fc_args.get('serial')),
+            selectors=tuple(selectors)
+        )
+
+
+class ScrapeControl:
+    def __init__(self):
+        """
+        Reusable and flexible scraping routines
+
+        Execute script with the launch() method ond an ScrapeControl() instance 
+        or from CLI, with or without arguments.
+
+        See README.md for usage.
+
+        """
+
+        self.path_jobs = 'scrape/'
+
+        # To pace requests, one token bucket per host
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+        # Response caches by folder, pools of processes parsing pages by size and of database 
+        # connections by settings, shared by workers
+        self.caches = {}
+        self.pools = {}
+        self.databases = {}
+
+        # Execution engine ('sync' or 'async'), routines run side by side and pages fetched ahead of use
+        self.engine = 'sync'
+        self.workers = 0
+        self.prefetched = {}
+
+        # Rows waiting to be written, by table and fields, and database connection leased by the routine
+        self.db_type = ''
+        self.database = None
+        self.conn = None
+        self.cur = None
+
+        # Writer stage of the routine if writing in background, connection held by one write at a time
+        self.writer = None
+        self.write_lock = threading.Lock()
+        self.pending_rows = {}
+        self.pending_count = 0
+
+        # Last serial value by output, table and field, read once per launch and shared by workers
+        self.serials = {}
+        self.serial_lock = threading.Lock()
+
+        # Content hashes by natural key of upserted tables with their keys and serial fields, read once per routine
+        self.hashes = {}
+        self.upserts = {}
+
+        # File outputs by table and their settings
+        self.sinks = {}
+        self.file_settings = {}
+
+        # Background downloads of the routine
+        self.downloads = None
+
+        # Keys of records seen by incremental routine, those new to store, and if current page was entirely seen
+        self.seen = None
+        self.new_seen = []
+        self.page_known = False
+
+        # Selection dictionaries compiled for the routine, and for worker processes in pipeline mode
+        self.selectors = {}
+        self.extraction = None
+
+        # Compiled routine running, and its post payload as paged
+        self.routine = None
+        self.payload = None
+
+        # Rows built by entry_to_db for iter_rows, written to outputs when None
+        self.emitted = None
+
+        # Resuming routines from checkpoints, state of current page and of last page scraped, rows written
+        self.resume = False
+        self.page_state = {}
+        self.checkpoint = None
+        self.rows_written = 0
+
+        # Timers and counters of the routine
+        self.metrics = Metrics()
+
+        # Pooled sessions per host and cookie jar shared by a routine's sessions
+        self.sessions = {}
+        self.cookies = requests.cookies.RequestsCookieJar()
+
+        # Load output settings from mandatory file
+        try:
+            with open(self.path_jobs + "settings.json", "r") as f:
+                self.settings = json.load(f)
+        except FileNotFoundError:
+            assert False, 'Error: file not found "settings.json".'
+
+        # Database settings are stored under their type
+        self.db_settings = {key: value for key, value in self.settings.items() if key in ['sql', 'csv']}
+        
+
+    def launch(self, files='', routines='', argv='', demo=False, engine='sync', resume=False, workers=0):
+        """
+        Method will execute requested routines, can be called from CLI as well.
+        Calling it without any files, routines or CLI arguments will execute 
+        every routine in every "scrape_settings_*.json" file.
+        With engine='async', routines run side by side and their pages are fetched concurrently.
+        With workers above 1 (or '--workers N' from CLI), routines run side by side on that many workers.
+        With resume=True, routines continue after the page of their checkpoint if any.
+        """
+        assert engine in ['sync', 'async'], "Error: engine '" + engine + "' not 'sync' or 'async'"
+        self.engine = engine
+        self.resume = resume
+        self.serials = {}
+
+        # Routines run side by side, from CLI if provided
+        self.workers = workers
+        if '--workers' in argv:
+            i = list(argv).index('--workers')
+            self.workers = int(argv[i + 1])
+            argv = list(argv[:i]) + list(argv[i + 2:])
+
+        # Stores files/routines from CLI arguments in lists
+        if argv[1:]:
+            self.check_argv(argv)
+
+        # Stores files/routines from method arguments in lists
+        elif files and routines:
+            if isinstance(files, str):
+                self.scrape_files = [files]
+            elif isinstance(files, list):
+                self.scrape_files = files
+
+            if isinstance(routines, str):
+                self.scrape_routines = [routines]
+            elif isinstance(routines, list):
+                self.scrape_routines = routines
+
+        # Stores files/routines as empty lists, selecting every files/routines
+        else:
+            self.scrape_files = [f for f in os.listdir('scrape') if 'scrape_' in f]
+            if not demo:
+                self.scrape_files = [f for f in self.scrape_files if '_demo' not in f]
+            self.scrape_routines = []
+
+        assert isinstance(self.scrape_files, list) and isinstance(self.scrape_routines, list), "Error: wrong routine or file given"
+        
+        # Get local files to list, filtered by self.scrape_files and nomenclature
+        files = [f for f in os.listdir('./scrape') if os.path.isfile('scrape/' + f)]
+        if self.scrape_files:
+            files = [f for f in files if f in self.scrape_files]
+# ?        files = [f for f in files if 'scrape_settings' in f and f.split('.')[-1] == 'json']
+        files = ['scrape/' + f for f in files]
+
+        # We go over every file's instructions, compiled
+        jobs = []
+        for file in files:
+
+            # We go over every routines in files, filtered by self.scrape_routines
+            for name, routine in self.load_routines(file).items():
+                if self.scrape_routines and name not in self.scrape_routines:
+                    continue
+                if isinstance(routine, Exception):
+                    raise routine
+                jobs.append((name, routine))
+
+        # Routines by priority, after those listed in their 'after'
+        jobs = self.order_jobs(jobs)
+
+        # We execute every routine, side by side for async engine or several workers
+        try:
+            if self.engine == 'async' or self.workers > 1:
+                asyncio.run(self.run_async(jobs))
+            else:
+                for name, routine in jobs:
+                    print('Running: ' + name)
+                    self.run(routine, name)
+
+        # Release pooled connections and processes, even if a routine failed
+        finally:
+            self.close_sessions()
+            self.close_pools()
+            self.close_databases()
+
+
+    def order_jobs(self, jobs):
+        """
+        Returns (name, routine) jobs ordered by the 'priority' of their parameters (highest 
+        first, 0 by default), every routine after those named in its 'after'. Names of 
+        routines not launched are ignored.
+        """
+        names = {name for name, routine in jobs}
+        pending = sorted(jobs, key=lambda job: -job[1].priority)
+        ordered, done = [], set()
+
+        while pending:
+            for job in pending:
+                if all(after in done for after in job[1].after if after in names):
+                    break
+            else:
+                assert False, "Error: routines " + str([name for name, routine in pending]) + " wait on each other with 'after'"
+
+            pending.remove(job)
+            ordered.append(job)
+            done.add(job[0])
+
+        return ordered
+
+
+    def load_routines(self, file):
+        """
+        Returns compiled routines of scrape file by name, or their error if invalid. They are cached 
+        on disk, reused while the file's modification time and size (else its content hash) and 
+        this module are unchanged.
+        """
+        stat = os.stat(file)
+        cache_file = os.path.join(os.path.dirname(file), '.compiled', os.path.basename(file) + '.pickle')
+        version = os.stat(__file__).st_mtime_ns
+
+        # Missing, corrupt or stale caches are compiled again
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            assert cached['version'] == version
+        except Exception:
+            cached = None
+
+        if cached and cached['stat'] == [stat.st_mtime_ns, stat.st_size]:
+            return cached['routines']
+
+        with open(file, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        # Errors of invalid routines are kept, raised only if they are launched
+        if cached and cached['hash'] == digest:
+            routines = cached['routines']
+        else:
+            routines = {}
+            for name, routine in json.loads(content).items():
+                try:
+                    routines[name] = Routine(name, routine)
+                except Exception as err:
+                    routines[name] = err
+
+        # Cache written whole or not at all, left out of read-only folders
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(cache_file + '.tmp', 'wb') as f:
+                pickle.dump({'version': version, 'stat': [stat.st_mtime_ns, stat.st_size], 'hash': digest, 'routines': routines}, f)
+            os.replace(cache_file + '.tmp', cache_file)
+        except OSError:
+            pass
+
+        return routines
+
+
+    async def run_async(self, jobs):
+        """
+        Schedules routines side by side, started in order of jobs once routines of their 'after' 
+        are done (skipped if one failed). At most 'routines' (or launch's workers) run at once, 
+        'host_routines' per host. Each runs on a worker instance with its own state and sessions, 
+        workers sharing per-host buckets so politeness holds across routines, or in a process 
+        of its own with the 'processes' scheduler (then never beside a routine allocating serials 
+        of a same table, processes counting them apart). Failures are raised once every routine ended.
+        """
+        settings = self.get_settings('engine', ENGINE_DEFAULTS)
+        assert settings['scheduler'] in ['threads', 'processes'], "Error: scheduler not 'threads' or 'processes'"
+        workers = self.workers or settings['routines']
+        pool = ProcessPoolExecutor(workers) if settings['scheduler'] == 'processes' else None
+
+        names = {name for name, routine in jobs}
+        pending = list(jobs)
+        running = {}
+        done, failed = set(), {}
+
+        while pending or running:
+
+            # Start routines ready, in order, within limits
+            hosts = [host for name, host, tables in running.values()]
+            tables = set().union(*[tables for name, host, tables in running.values()])
+            for name, routine in list(pending):
+                if len(running) >= workers:
+                    break
+                after = [after for after in routine.after if after in names]
+
+                # Skip routines after a failed one
+                if any(name_after in failed for name_after in after):
+                    pending.remove((name, routine))
+                    failed[name] = None
+                    print('Skipped: ' + name + ' (after failed routine)')
+                    continue
+
+                host = routine.host
+                if any(name_after not in done for name_after in after) or host and hosts.count(host) >= settings['host_routines']:
+                    continue
+                if pool and routine.serial_tables & tables:
+                    continue
+
+                pending.remove((name, routine))
+                running[asyncio.create_task(self.run_job(name, routine, pool))] = (name, host, routine.serial_tables)
+                hosts.append(host)
+                tables |= routine.serial_tables
+
+            if not running:
+                continue
+
+            # Wait for a routine to end
+            finished, _ = await asyncio.wait(list(running.keys()), return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                name, host, serial_tables = running.pop(task)
+                if task.exception():
+                    failed[name] = task.exception()
+                    print('Failed: ' + name + ' (' + repr(task.exception()) + ')')
+                else:
+                    done.add(name)
+
+        if pool:
+            pool.shutdown()
+
+        for error in failed.values():
+            if error:
+                raise error
+
+
+    async def run_job(self, name, routine, pool=None):
+        """
+        Runs routine on a worker instance in a thread, or in pool's process if provided.
+        """
+        print('Running: ' + name)
+        if pool:
+            await asyncio.get_running_loop().run_in_executor(pool, run_routine, name, routine, self.engine, self.resume)
+            return
+
+        worker = self.spawn()
+        try:
+            await asyncio.to_thread(worker.run, routine, name)
+        finally:
+            worker.release_database()
+            worker.close_sessions()
+
+
+    def spawn(self):
+        """
+        Returns copy of instance to run a routine in parallel. Settings, buckets, pools and 
+        lock are shared, sessions, cookies, database connection and pages are its own.
+        """
+        worker = copy.copy(self)
+        worker.sessions = {}
+        worker.cookies = requests.cookies.RequestsCookieJar()
+        worker.prefetched = {}
+        worker.pending_rows = {}
+        worker.pending_count = 0
+        worker.conn = None
+        worker.cur = None
+        worker.writer = None
+        worker.write_lock = threading.Lock()
+        worker.sinks = {}
+        worker.selectors = {}
+        worker.downloads = None
+        worker.page_state = {}
+        worker.checkpoint = None
+        worker.emitted = None
+        worker.metrics = Metrics()
+        return worker
+
+
+    def run(self, routine, routine_name):
+        """
+        Method executes a routine, calling functions in the order inserted. 
+        """
+        try:
+            checkpoint = self.prepare(routine, routine_name)
+
+            for page_url in self.scrape_pages(checkpoint):
+
+                # Store keys seen and checkpoint once their rows are written, by writer stage if any
+                if not self.pending_count and self.writer:
+                    self.writer.submit({}, self.checkpoint, self.new_seen)
+                    self.new_seen = []
+                elif not self.pending_count:
+                    self.save_seen()
+                    self.save_checkpoint()
+
+            # Write rows left in batch and wait for writer stage
+            self.flush_rows()
+            self.join_writer()
+            self.close_sinks()
+            self.save_seen()
+
+        # Connection returned and downloads waited for, even if the routine failed
+        finally:
+            self.release_database()
+            self.join_downloads()
+
+        # Routine complete, nothing to resume
+        self.clear_checkpoint()
+        self.report_metrics()
+
+
+    def iter_rows(self, routine, routine_name='rows', transforms=()):
+        """
+        Yields rows of routine as entry_to_db builds them instead of writing them, passed 
+        through transforms in order (callables taking an iterator of rows and returning one). 
+        Pages are requested as rows are consumed, a page's soup released before its rows are yielded.
+        """
+        rows = self.emit_rows(routine, routine_name)
+        for transform in transforms:
+            rows = transform(rows)
+        yield from rows
+
+
+    def emit_rows(self, routine, routine_name):
+        """
+        Yields rows built by entry_to_db page by page, keys seen stored once a page's rows are consumed.
+        """
+        self.emitted = []
+        try:
+            checkpoint = self.prepare(routine, routine_name)
+            for page_url in self.scrape_pages(checkpoint):
+                rows, self.emitted = self.emitted, []
+                yield from rows
+                self.save_seen()
+        finally:
+            self.emitted = None
+            self.release_database()
+            self.join_downloads()
+            self.report_metrics()
+
+
+    def prepare(self, routine, routine_name):
+        """
+        Prepares state, outputs and requests of a routine (compiled if given as dictionary). 
+        Returns checkpoint to resume from, if any.
+        """
+        if not isinstance(routine, Routine):
+            routine = Routine(routine_name, routine)
+        for fc, fc_args in routine.functions:
+            assert callable(getattr(self, fc, None)), "Error: function '" + fc + "' not found"
+        self.routine = routine
+        self.parameters = routine.parameters
+        self.routine_name = routine_name
+        self.metrics = Metrics()
+
+        # Hashes are read again from tables, selection dictionaries taken compiled from routine
+        self.hashes = {}
+        self.upserts = {}
+        self.selectors = {(id(element_dic), compiler): (element_dic, compiled) for element_dic, compiler, compiled in routine.selectors}
+
+        # Fresh cookie jar for the routine, shared by every pooled session
+        self.cookies = requests.cookies.RequestsCookieJar()
+        for session in self.sessions.values():
+            session.cookies = self.cookies
+
+        # Pages parsed and searched by worker processes in pipeline mode
+        self.extraction = None
+        if self.get_settings('engine', ENGINE_DEFAULTS)['processes']:
+            self.extraction = self.compile_extraction()
+
+        # Path for downloaded pages, folder created if absent
+        self.path_out = routine.path_out
+        if self.path_out and not os.path.exists(self.path_out):
+            os.makedirs(self.path_out)
+
+        # Urls and request of routine
+        self.urls = routine.urls
+        self.request_type = routine.request_type
+
+        # Prepare database based on settings priority, type from routine else first in settings
+        if "settings" in self.parameters.keys():
+            db_settings_dic = self.parameters['settings']
+            db_settings_type = self.parameters.get('database', 'sql')
+        elif self.db_settings:
+            assert isinstance(self.db_settings, dict), 'Error: not dict for routine in database_setting.json'
+            db_settings_type = self.parameters.get('database', list(self.db_settings.keys())[0])
+            db_settings_dic = self.db_settings.get(db_settings_type, {})
+        else: 
+            db_settings_type = self.parameters.get('database', 'csv')
+            db_settings_dic = {}
+        self.database_setup(db_settings_type, db_settings_dic)
+
+        # Keys of records already seen for incremental routines
+        self.load_seen()
+
+        # Resume from checkpoint, downloads left pending are queued again
+        checkpoint = self.load_checkpoint()
+        self.checkpoint = None
+        self.rows_written = 0
+        if checkpoint:
+            print('Resuming: ' + routine_name + ' after ' + checkpoint['url'])
+            self.rows_written = checkpoint['rows']
+            for url, file_name in checkpoint['downloads']:
+                self.submit_download(url, file_name)
+
+        return checkpoint
+
+
+    def scrape_pages(self, checkpoint=None):
+        """
+        Yields url of every page of routine once its functions are called, its soup and 
+        values released. Urls done before checkpoint are skipped.
+        """
+        url_start = checkpoint['url_index'] if checkpoint else 0
+
+        # Landing pages fetched concurrently by the async engine, a window ahead of their use 
+        # (page of checkpoint is requested instead of the landing page it resumes)
+        prefetch = self.engine == 'async' and self.request_type == 'get' and self.routine.pagination.kind != 'in_url' and 'archive' not in self.parameters.keys()
+        window = self.get_settings('engine', ENGINE_DEFAULTS)['concurrency']
+
+        # Get landing page
+        for url_index, url in enumerate(self.urls[url_start:], url_start):
+            self.url = url
+            resume = checkpoint if checkpoint and url_index == checkpoint['url_index'] else None
+
+            if prefetch and (url_index - url_start) % window == 0:
+                landings = [landing for i, landing in enumerate(self.urls[url_index:url_index + window], url_index) if not (checkpoint and i == checkpoint['url_index'])]
+                self.prefetch([('get', landing) for landing in landings])
+
+            # Iterate over pages to scrape until no "next_page" url yielded
+            for page_url in self.iter_pages(self.request_type, resume):
+                self.page_known = False
+
+                # Iterate over functions and call them
+                for fc, fc_args in self.routine.functions:
+
+                    # Call function with arguments provided, timed by name
+                    with self.metrics.timer(fc):
+                        getattr(self, fc)(fc_args)
+
+                # Page scraped, only its rows are kept
+                self.metrics.count('pages')
+                self.soup = None
+                self.scrape_results = {}
+                self.checkpoint = dict(self.page_state, url_index=url_index)
+                yield page_url
+
+                # Incremental routines stop at first page entirely seen
+                if self.page_known and self.get_settings('incremental', INCREMENTAL_DEFAULTS)['stop']:
+                    break
+
+
+    def load_seen(self):
+        """
+        Loads keys of records already seen by an incremental routine, from local file 
+        or target table, once per routine. self.seen is None for other routines.
+        """
+        self.seen = None
+        self.new_seen = []
+        if 'incremental' not in self.parameters.keys():
+            return
+
+        settings = self.get_settings('incremental', INCREMENTAL_DEFAULTS)
+        assert settings['key'], "Error: no 'key' for incremental routine"
+        assert settings['store'] in ['local', 'table'], "Error: incremental store not 'local' or 'table'"
+        self.seen = set()
+
+        # Keys of target table
+        if settings['store'] == 'table':
+            assert self.db_type == 'sql' and settings['table'], "Error: incremental store 'table' needs an sql database and 'table'"
+            self.cur.execute('SELECT ' + (settings['column'] or settings['key']) + ' FROM ' + settings['table'] + ';')
+            self.seen = {str(value).strip() for value, in self.cur.fetchall()}
+
+        # Keys stored by previous runs, one per line
+        elif os.path.exists(self.seen_file(settings)):
+            with open(self.seen_file(settings), encoding='utf-8') as f:
+                self.seen = {line.rstrip('\n') for line in f}
+
+
+    def save_seen(self, keys=None):
+        """
+        Appends keys seen since last call (or keys given) to the incremental routine's local file.
+        """
+        if keys is None:
+            keys, self.new_seen = self.new_seen, []
+        if not keys:
+            return
+
+        settings = self.get_settings('incremental', INCREMENTAL_DEFAULTS)
+        if settings['store'] == 'local':
+            os.makedirs(settings['path'], exist_ok=True)
+            with open(self.seen_file(settings), 'a', encoding='utf-8') as f:
+                f.write(''.join(key + '\n' for key in keys))
+
+
+    def seen_file(self, settings):
+        """
+        Returns file of keys seen by routine.
+        """
+        path = settings['path'] if settings['path'][-1] in ['/', '\\'] else settings['path'] + '/'
+        return path + self.routine_name + '.seen'
+
+
+    def seen_key(self, value):
+        """
+        Returns key of record's value as stored, urls made absolute as entry_to_db does.
+        """
+        if self.get_settings('incremental', INCREMENTAL_DEFAULTS)['key'] in ['href', 'url']:
+            value = self.parse_url(self.url, value)
+        return str(value).strip()
+
+
+    def iter_pages(self, request_type, resume=None):
+        """
+        Yields url of every page to scrape from self.url, after storing its soup in self.soup 
+        and its state in self.page_state. Bounces on 'first_page', then follows 'next_page' 
+        (selected url, post payload or 'in_url' range). Given a checkpoint, starts after its page.
+        The post payload is copied, its page counted in self.payload.
+        """
+        pagination = self.routine.pagination
+        self.payload = dict(self.parameters['payload']) if request_type == 'post' else None
+
+        # Pages of a local archive, without pagination
+        if 'archive' in self.parameters.keys():
+            yield from self.iter_archive(resume)
+            return
+
+        # Every page is known ahead for 'in_url' ranges, fetched concurrently by windows kept in order
+        if pagination.kind == 'in_url':
+            plan = self.plan_in_url(pagination.in_url)
+            start = plan.index(resume['in_url']) + 1 if resume and resume.get('in_url') in plan else 0
+            urls = [self.url % tuple(params) for params in plan]
+            window = self.get_settings('engine', ENGINE_DEFAULTS)['concurrency']
+
+            for i in range(start, len(urls), window):
+                contents = self.fetch_all([('get', url) for url in urls[i:i + window]])
+
+                for j, (url, page) in enumerate(zip(urls[i:i + window], self.parse_pages(contents)), i):
+                    self.soup = page
+                    self.page_state = {'url': url, 'in_url': plan[j]}
+                    del page
+                    yield url
+            return
+
+        # Page of checkpoint is requested again to follow 'next_page' from it
+        if resume:
+            if not pagination.kind:
+                return
+            self.url = resume['url']
+            if request_type == 'post':
+                self.payload.update(resume['payload'])
+                self.soup = self.get_request('post', self.url, payload=self.payload)
+            else:
+                self.soup = self.get_request('get', self.url)
+
+        # Execution logic for 'get'
+        elif request_type == 'get':
+            self.soup = self.get_request('get', self.url)
+                
+            # Bounce from initial soup with 'first_page' dictionary selecting a new url.
+            if pagination.first_page:
+                url_new = self.get_elements(pagination.first_page)
+                
+                # Presently useless, mostly //TODO
+                if 'optional' in pagination.first_page.keys():
+                    optional = pagination.first_page['optional']
+                else: 
+                    optional = True
+
+                # Processs new url if found
+                if url_new:
+                    url = self.parse_url(self.url, url_new)
+                    assert isinstance(url, str) and url, 'Error: Empty url provided for first page'
+                    # //TODO validate
+                    
+                    # Store cleaned news url as base url and get new request
+                    self.url = url
+                    self.soup = self.get_request('get', self.url)
+
+                # If no new url yielded
+                else:
+                    assert optional, 'Error: no url_new while non-optional, add parameter or verify'
+
+        # //TODO add post request logic
+        elif request_type  == 'post':
+            self.soup = self.get_request('post', self.url, payload=self.payload)
+
+        while True:
+
+            # Next url selected before page is scraped and its soup released
+            url_next = self.select_next_url(pagination.links) if pagination.kind == 'link' else ''
+
+            # Page of checkpoint was scraped already
+            if resume:
+                resume = None
+            else:
+                self.page_state = {'url': self.url, 'payload': dict(self.payload) if request_type == 'post' else None}
+                yield self.url
+
+            # Don't loop without 'next_page' instruction
+            if not pagination.kind:
+                return
+
+            # Post request logic #//TODO fix/do
+            if request_type == 'post':
+                page_value = self.payload[pagination.payload]
+                next_page_value = page_value + 1
+                if next_page_value > pagination.max:
+                    return
+                self.payload[pagination.payload] = next_page_value
+                self.soup = self.get_request('post', self.url, payload=self.payload)
+
+            # Get request logic
+            elif request_type == 'get':
+                if not url_next:
+                    #assert optional, 'Error: non-optional url_new empty in next_page'
+                    return
+                self.url = url_next
+                self.soup = self.get_request('get', self.url)
+
+
+    def select_next_url(self, next_page):
+        """
+        Returns next url of current page, from first selection dictionary of next_page 
+        yielding one, else ''.
+        """
+        # Get new url from every selection_dictionary provided, until non is yielded 
+        for element_dic in next_page:
+            
+            # Update url, //TODO merge with first_page and expand url parsing
+            url_new = self.get_elements(element_dic)
+            if url_new:
+                url = self.parse_url(self.url, url_new)
+                if url:
+                    return url
+        return ''
+
+
+    def report_metrics(self):
+        """
+        Prints summary of routine's timers and counters, and writes report if a path is set.
+        """
+        settings = self.get_settings('metrics', METRICS_DEFAULTS)
+        assert settings['format'] in ['json', 'prometheus'], "Error: metrics format not 'json' or 'prometheus'"
+        if settings['summary']:
+            print(self.metrics.summary(self.routine_name))
+        if not settings['path']:
+            return
+
+        path = settings['path'] if settings['path'][-1] in ['/', '\\'] else settings['path'] + '/'
+        os.makedirs(path, exist_ok=True)
+        if settings['format'] == 'json':
+            with open(path + self.routine_name + '.json', 'w', encoding='utf-8') as f:
+                json.dump(dict(self.metrics.report(), routine=self.routine_name), f, indent=4)
+        else:
+            with open(path + self.routine_name + '.prom', 'w', encoding='utf-8') as f:
+                f.write(self.metrics.prometheus(self.routine_name))
+
+
+    def load_checkpoint(self):
+        """
+        Returns checkpoint stored for routine when resuming, None otherwise.
+        """
+        settings = self.get_settings('checkpoint', CHECKPOINT_DEFAULTS)
+        if not self.resume or not settings['enabled'] or not os.path.exists(self.checkpoint_file(settings)):
+            return None
+
+        with open(self.checkpoint_file(settings), encoding='utf-8') as f:
+            return json.load(f)
+
+
+    def save_checkpoint(self, checkpoint=None):
+        """
+        Writes checkpoint of last page scraped (or checkpoint given), with count of rows written 
+        and downloads pending. Written to a temporary file synced to disk then renamed, never 
+        left half written.
+        """
+        settings = self.get_settings('checkpoint', CHECKPOINT_DEFAULTS)
+        checkpoint = checkpoint or self.checkpoint
+        if not settings['enabled'] or not checkpoint:
+            return
+
+        # Rows written to files since last checkpoint are on disk before being counted as written
+        for sink in list(self.sinks.values()):
+            with sink.lock:
+                if sink.unsaved:
+                    sink.flush()
+                    sink.file.flush()
+                    sink.unsaved = False
+
+        checkpoint = dict(checkpoint, rows=self.rows_written)
+        checkpoint['downloads'] = self.downloads.pending_downloads() if self.downloads else []
+
+        file_name = self.checkpoint_file(settings)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(file_name + '.tmp', file_name)
+
+
+    def clear_checkpoint(self):
+        """
+        Deletes checkpoint of completed routine.
+        """
+        self.checkpoint = None
+        file_name = self.checkpoint_file(self.get_settings('checkpoint', CHECKPOINT_DEFAULTS))
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+
+    def checkpoint_file(self, settings):
+        """
+        Returns checkpoint file of routine.
+        """
+        path = settings['path'] if settings['path'][-1] in ['/', '\\'] else settings['path'] + '/'
+        return path + self.routine_name + '.checkpoint.json'
+
+
+    def iter_archive(self, resume=None):
+        """
+        Yields name of every page of the routine's archive, after storing its soup in self.soup. 
+        Pages are read and parsed by windows, side by side by worker processes in pipeline mode. 
+        Given a checkpoint, starts after its page.
+        """
+        settings = self.get_settings('archive', ARCHIVE_DEFAULTS)
+        pages = iter(PageArchive(settings['path'], settings['suffixes']))
+
+        # Pages up to checkpoint's one were scraped already
+        if resume:
+            for name, file_name, content in pages:
+                if name == resume['url']:
+                    break
+
+        while True:
+            window = list(islice(pages, settings['window']))
+            if not window:
+                return
+
+            names, file_names, contents = zip(*window)
+            for name, page in zip(names, self.parse_pages(contents, file_names)):
+                self.url = settings['url'] or name
+                self.soup = page
+                self.page_state = {'url': name}
+                del page
+                yield name
+
+
+    def plan_in_url(self, next_page):
+        """
+        Returns every params tuple for 'in_url' from 'start' to 'end' (inclusive), counting 
+        up or down. Supports 'year' with 'quarter' or 'month', a 'date' (stepped by 'step' 
+        days, formatted by 'date_format') or a generic integer counter (stepped by 'step').
+        """
+        in_url = next_page['in_url']
+        start, end = list(next_page['start']), list(next_page['end'])
+        assert len(in_url) == len(start) == len(end), "Error: 'in_url', 'start' and 'end' not of same length"
+
+        # Period lengths of params carried into 'year'
+        cycles = {'quarter': 4, 'month': 12}
+
+        # Convert params to a single ordinal counter and back
+        if 'year' in in_url and any(name in cycles for name in in_url):
+            i_year = in_url.index('year')
+            i_cycle = [i for i, name in enumerate(in_url) if name in cycles][0]
+            cycle = cycles[in_url[i_cycle]]
+
+            def to_ordinal(params):
+                return int(params[i_year]) * cycle + int(params[i_cycle]) - 1
+
+            def from_ordinal(ordinal):
+                params = list(start)
+                params[i_year], params[i_cycle] = ordinal // cycle, ordinal % cycle + 1
+                return params
+
+        elif 'date' in in_url:
+            i_date = in_url.index('date')
+            date_format = next_page.get('date_format', '%Y-%m-%d')
+
+            def to_ordinal(params):
+                return datetime.strptime(params[i_date], date_format).toordinal()
+
+            def from_ordinal(ordinal):
+                params = list(start)
+                params[i_date] = datetime.fromordinal(ordinal).strftime(date_format)
+                return params
+
+        else:
+            assert len(in_url) == 1, "Error: generic 'in_url' counter takes a single param"
+
+            def to_ordinal(params):
+                return int(params[0])
+
+            def from_ordinal(ordinal):
+                return [ordinal]
+
+        first, last = to_ordinal(start), to_ordinal(end)
+        step = abs(next_page.get('step', 1)) * (1 if last >= first else -1)
+        assert step, "Error: 'step' of 'in_url' is 0"
+
+        return [from_ordinal(ordinal) for ordinal in range(first, last + step // abs(step), step)]
+
+
+    def check_argv(self, argv, demo=False):
+        """
+        Parse CLI arguments provided and stores appropriate lists in 
+        storage attributes (self.scrape_files and self.scrape_routines)
+        """
+        # Only first arg (files) provided
+        if len(argv) in [2]:
+            self.scrape_files = argv[1]
+            self.scrape_routines = []
+
+        # Both args provided
+        elif len(argv) in [3]:
+            self.scrape_files = argv[1]
+            self.scrape_routines = argv[2]
+
+        # No args provided, returns empty list
+        else:
+            self.scrape_files = []
+            self.scrape_routines = []
+            return
+
+        # Converts str to list
+        if self.scrape_files and isinstance(self.scrape_files, str):
+            if len(self.scrape_files) > 1 and self.scrape_files[0] == ['['] and self.scrape_files[1] == [']'] :
+                self.scrape_files = eval(self.scrape_files)
+            else:
+                self.scrape_files = [self.scrape_files]
+
+        # Converts str to list
+        if self.scrape_routines and isinstance(self.scrape_routines, str):
+            if len(self.scrape_routines) > 1 and self.scrape_routines[0] == ['['] and self.scrape_routines[1] == [']'] :
+                self.scrape_routines = eval(self.scrape_routines)
+            else:
+                self.scrape_routines = [self.scrape_routines]
+
+
+    def database_setup(self, db_type, db_settings=''):
+        """
+        Initialize ways of outputting scraped data. 
+        Passing it a settings dictionary over-rides priority. 
+        """
+        assert db_type in ['sql', 'csv'], "Error: '" + db_type + "' for database not 'sql' or 'csv'"
+
+
+        # //TODO check for prio?
+        if not db_settings and db_type == 'sql':
+            db_settings = self.db_settings[db_type]
+        self.db_type = db_type
+
+        # Lease connection to SQL database for the routine, previous routine's returned
+        self.release_database()
+        if db_type == 'sql':
+            self.database = self.get_database(db_settings)
+            self.conn = self.database.lease()
+            self.cur = self.conn.cursor()
+
+        # Settings for files to output, over-ridden by those provided
+        self.file_settings = {}
+        if db_type == 'csv':
+            self.file_settings = dict(self.get_settings('csv', FILE_DEFAULTS), **db_settings)
+
+
+    def get_database(self, db_settings):
+        """
+        Returns pool of connections to database of settings, shared by workers.
+        """
+        key = json.dumps(db_settings, sort_keys=True, default=str)
+        with self.lock:
+            if key not in self.databases:
+                self.databases[key] = ConnectionPool(db_settings, self.get_settings('pool', POOL_DEFAULTS))
+            return self.databases[key]
+
+
+    def release_database(self):
+        """
+        Returns routine's database connection to its pool, once writer stage stopped.
+        """
+        # Writer stage of an interrupted routine stopped, the routine's own error being raised
+        try:
+            self.join_writer()
+        except Exception:
+            pass
+
+        if self.conn is not None:
+            if not self.conn.closed:
+                self.cur.close()
+            self.database.release(self.conn)
+        self.conn = None
+        self.cur = None
+
+
+    def reconnect(self):
+        """
+        Replaces routine's lost database connection by one leased from its pool. Called by 
+        writer threads, the writer stage is left running.
+        """
+        self.database.release(self.conn)
+        self.conn = self.database.lease()
+        self.cur = self.conn.cursor()
+
+
+    def close_databases(self):
+        """
+        Closes pooled database connections.
+        """
+        self.release_database()
+        for database in self.databases.values():
+            database.close()
+        self.databases = {}
+
+
+    def get_request(self, type_req, url, payload='', headers='', limiter=''):
+        """
+        Returns soup of requested url. Requests are paced per host by token buckets, 
+        limiter (seconds between requests) over-rides the routine's rate if provided.
+        //TODO Add/finish post details, probably doesn't work ATM
+        """
+        content = self.get_content(type_req, url, payload=payload, headers=headers, limiter=limiter)
+
+        # Get requested soup, or its values from a worker process in pipeline mode
+        return next(self.parse_pages([content])) #//TODO save as pickle?
+
+
+    def parse_page(self, content):
+        """
+        Returns page parsed by the routine's 'parser': BeautifulSoup ('soup', default) 
+        or raw lxml.html tree ('lxml'), faster and lighter for high-volume routines.
+        """
+        return PageExtraction.parse(content, self.parameters.get('parser', 'soup'))
+
+
+    def parse_pages(self, contents, file_names=()):
+        """
+        Yields page of every content in order, or of local file where file name is given. 
+        In pipeline mode, contents are all sent to worker processes parsing them side by 
+        side (local files read there), and their PageValues yielded.
+        """
+        file_names = file_names or [''] * len(contents)
+        if not self.extraction:
+            for content, file_name in zip(contents, file_names):
+                if file_name:
+                    with self.metrics.timer('read'):
+                        content = PageArchive.read(file_name)
+                with self.metrics.timer('parse'):
+                    page = self.parse_page(content)
+                yield page
+            return
+
+        # Time spent by workers, and waiting for them
+        pool = self.get_pool(self.get_settings('engine', ENGINE_DEFAULTS)['processes'])
+        futures = [pool.submit(self.extraction, content, file_name) for content, file_name in zip(contents, file_names)]
+        for future in futures:
+            with self.metrics.timer('parse_wait'):
+                page = future.result()
+            for name, seconds in page.timings.items():
+                self.metrics.add_time('worker_' + name, seconds)
+            yield page
+
+
+    def compile_extraction(self):
+        """
+        Returns PageExtraction of routine's 'first_page', 'next_page' and scrape_values selections.
+        """
+        # Selected next urls only, 'in_url' ranges and payloads need no page
+        pagination = self.routine.pagination
+        element_dics = ([pagination.first_page] if pagination.first_page else []) + list(pagination.links)
+
+        values_dics = [fc_args for fc, fc_args in self.routine.functions if fc == 'scrape_values']
+        return PageExtraction(self.parameters.get('parser', 'soup'), element_dics, values_dics)
+
+
+    def get_pool(self, processes):
+        """
+        Returns pool of processes parsing pages, shared by workers.
+        """
+        with self.lock:
+            if processes not in self.pools:
+                self.pools[processes] = ProcessPoolExecutor(processes)
+            return self.pools[processes]
+
+
+    def close_pools(self):
+        """
+        Stops processes parsing pages.
+        """
+        for pool in self.pools.values():
+            pool.shutdown()
+        self.pools = {}
+
+
+    def get_content(self, type_req, url, payload='', headers='', limiter='', stream=False):
+        """
+        Returns content of requested url or local html file, from prefetched pages if present. 
+        With stream, returns an iterator of raw byte chunks instead, read as they arrive. 
+        Safe to call from several threads.
+        """
+        assert type_req.lower() in ['get', 'post'], "Error: '" + type_req.lower() + "' request not 'get' or 'post'."
+        assert isinstance(url, str) and len(url) > 3 and '.' in url, "Error: invalid url '" + url + "'"
+        chunk_size = self.get_settings('download', DOWNLOAD_DEFAULTS)['chunk_size']
+
+        # Page already fetched by the async engine
+        if (type_req.lower(), url) in self.prefetched:
+            content = self.prefetched.pop((type_req.lower(), url))
+            if stream:
+                return iter([content.encode('utf-8') if isinstance(content, str) else content])
+            return content
+
+        # Read local files, without throttle
+        file_name = self.local_file(url)
+        if file_name:
+            if stream:
+                return self.iter_file(file_name, chunk_size)
+            content = PageArchive.read(file_name)
+
+        else:
+            #//TODO CHeck up
+            if 'headers' in self.parameters.keys():
+                headers = self.parameters['headers']
+            else:
+                headers = {}
+
+            # Serve cached response if still fresh, else revalidate it
+            cache_settings = self.get_settings('cache', CACHE_DEFAULTS)
+            assert cache_settings['policy'] in ['off', 'ttl', 'force'], "Error: cache policy not 'off', 'ttl' or 'force'"
+            cached = None
+            if cache_settings['policy'] != 'off':
+                cache = self.get_cache(cache_settings)
+                key = cache.key(type_req, url, payload)
+                cached = cache.get(key)
+
+            if cached:
+                meta, content = cached
+                if cache_settings['policy'] == 'force' or time.time() - meta['stored'] < cache_settings['ttl']:
+                    self.metrics.count('cache_hits')
+                    return iter([content]) if stream else content
+
+                headers = dict(headers)
+                if meta['etag']:
+                    headers['If-None-Match'] = meta['etag']
+                if meta['last_modified']:
+                    headers['If-Modified-Since'] = meta['last_modified']
+
+            session = self.get_session(url)
+            timeout = self.get_settings('session', SESSION_DEFAULTS)['timeout']
+            limiter_settings = self.get_settings('limiter', LIMITER_DEFAULTS)
+            if limiter:
+                limiter_settings['rate'] = 1 / limiter
+            bucket = self.get_bucket(url, limiter_settings)
+
+            # Back off and retry while server is throttling us
+            for attempt in range(limiter_settings['max_retries'] + 1):
+
+                # Wait for the host's bucket
+                wait = bucket.acquire()
+                if wait > 0:
+                    with self.metrics.timer('throttle'):
+                        time.sleep(wait)
+
+                # Payload for post, sent over the host's pooled session, body read later if streamed
+                # (responses to cache are read whole)
+                stream_body = stream and cache_settings['policy'] == 'off'
+                start = time.perf_counter()
+                if isinstance(payload, dict):
+                    response = session.request(type_req.upper(), url, headers=headers, data=payload, timeout=timeout, stream=stream_body) #//todo VALIDATE
+                else:
+                    response = session.request(type_req.upper(), url, headers=headers, timeout=timeout, stream=stream_body)
+
+                # Time to headers (with DNS and connection, not timed apart by requests), then body read
+                seconds = time.perf_counter() - start
+                self.metrics.count('requests')
+                self.metrics.add_time('ttfb', min(response.elapsed.total_seconds(), seconds))
+                if not stream_body:
+                    self.metrics.add_time('download', max(seconds - response.elapsed.total_seconds(), 0))
+
+                if response.status_code not in [429, 503]:
+                    break
+                response.close()
+                self.metrics.count('retries')
+
+                # Hold every request to the host, not only this one
+                bucket.block(self.get_retry_after(response, attempt, limiter_settings))
+
+            # Unchanged since cached
+            if cached and response.status_code == 304:
+                self.metrics.count('cache_hits')
+                cache.refresh(key, meta)
+                return iter([content]) if stream else content
+
+            if response.status_code != 200:
+                response.close()
+            assert response.status_code == 200, "Error: Status code " + str(response.status_code) + " of request"
+            #//TODO add contingencies
 
-        assert isinstance(self.scrape_files, list) and isinstance(self.scrape_routines, list), "Error: wrong routine or file given"
-        
-        # Get local files to list, filtered by self.scrape_files and nomenclature
-        files = [f for f in os.listdir('./scrape') if os.path.isfile('scrape/' + f)]
-        if self.scrape_files:
-            files = [f for f in files if f in self.scrape_files]
-# ?        files = [f for f in files if 'scrape_settings' in f and f.split('.')[-1] == 'json']
-        files = ['scrape/' + f for f in files]
+            if stream_body:
+                return self.iter_response(response, chunk_size)
+            content = response.content
+            self.metrics.count('bytes', len(content))
 
-        # We go over every file's instructions
-        for file in files:
-            with open(file, "r") as f:
-                dic = json.load(f)
+            if cache_settings['policy'] != 'off':
+                cache.put(key, url, response)
+            if stream:
+                return iter([content])
 
-            # We go over every routines in files, filtered by self.scrape_routines
-            for name, routine in dic.items():
-                if self.scrape_routines and name not in self.scrape_routines:
-                    continue
+        return content
 
-                # We execute every routine
-                print('Running: ' + name)
-                self.run(routine, name)
 
+    @staticmethod
+    def local_file(url):
+        """
+        Returns path of url if local ('file://' url or path of an existing file), else ''.
+        """
+        parts = urlsplit(url)
+        if parts.scheme == 'file':
+            return unquote(parts.path)
+        if parts.scheme not in ['http', 'https'] and os.path.isfile(url):
+            return url
+        return ''
 
 
-    def run(self, routine, routine_name):
+    @staticmethod
+    def iter_response(response, chunk_size):
         """
-        Method executes a routine, calling functions in the order inserted. 
+        Yields raw body of response by chunks, releasing its connection once read.
         """
+        try:
+            yield from response.iter_content(chunk_size)
+        finally:
+            response.close()
 
-        assert 'parameters' in routine.keys(), "Error: parameters dict not found in rountine."
-        self.parameters = routine['parameters']
 
-        # Verify inputs in parameters
-        for mandatory_parameter in ['url']:
-            assert mandatory_parameter in self.parameters.keys(), "Error: '" + mandatory_parameter + "' not found in dict's parameters."
+    @staticmethod
+    def iter_file(file_name, chunk_size):
+        """
+        Yields bytes of local file by chunks.
+        """
+        with open(file_name, 'rb') as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
 
-        # Store path for downloaded pages
-        if 'path_out' in self.parameters.keys() and self.parameters['path_out'][-1] not in ['/', '\\']:
-            self.parameters['path_out'] += '/' 
-        self.path_out = self.parameters['path_out']
 
-        # Create folder if absent
-        if not os.path.exists(self.path_out):
-            os.mkdir(self.path_out)
+    def prefetch(self, requests_list):
+        """
+        Fetches (type_req, url) requests concurrently into self.prefetched, in place of pages 
+        left unused. Pages that failed are left out, requested again when used and their error 
+        raised then, after earlier pages are scraped.
+        """
+        contents = self.fetch_all(requests_list, return_exceptions=True)
+        self.prefetched = {request: content for request, content in zip(requests_list, contents) if not isinstance(content, BaseException)}
 
-        # Store url or urls in parameters as list
-        if not isinstance(self.parameters['url'], list):
-            self.urls = [self.parameters['url']]
-        else:
-            self.urls = self.parameters['url']
 
-        # Prepare database based on settings priority
-        if "settings" in self.parameters.keys():
-            db_settings_dic = self.parameters['settings']
-            db_settings_type = self.parameters.key()
-        elif self.db_settings:
-            assert isinstance(self.db_settings, dict), 'Error: not dict for routine in database_setting.json'
-            for key, value in self.db_settings.items():
-                db_settings_dic = value
-                db_settings_type = key
-        else: 
-            assert False, 'What now?'
-        self.database_setup(db_settings_type, db_settings_dic)
+    def fetch_all(self, requests_list, return_exceptions=False):
+        """
+        Returns contents of (type_req, url[, payload]) requests fetched concurrently, 
+        in the order requested, or their errors with return_exceptions. Each host is still 
+        paced by its bucket.
+        """
+        semaphore = asyncio.Semaphore(self.get_settings('engine', ENGINE_DEFAULTS)['concurrency'])
 
-        # Get landing page
-        for url in self.urls:
-            self.url = url
+        async def fetch(request):
+            async with semaphore:
+                return await asyncio.to_thread(self.get_content, *request)
 
-            # Default requests as 'get' #//TODO requesting post may not work ATM
-            if 'request' in self.parameters.keys():
-                request_type = self.parameters['request']
-            else:
-                request_type = 'get'
+        async def gather():
+            return await asyncio.gather(*[fetch(request) for request in requests_list], return_exceptions=return_exceptions)
 
-            if 'in_url' in self.parameters['next_page'].keys():
-                params = tuple(str(param) for param in self.parameters['next_page']['start'])
-                
-                url = self.url % params
+        return asyncio.run(gather())
 
-                        
-            # Execution logic for 'get'
-            if request_type == 'get':
-                self.soup = self.get_request('get', url)
-                    
-                # Bounce from initial soup with 'first_page' dictionary selecting a new url.
-                if 'first_page' in self.parameters.keys():
-                    url_new = self.get_elements(self.parameters['first_page'])
-                    
-                    # Presently useless, mostly //TODO
-                    if 'optional' in self.parameters['first_page'].keys():
-                        optional = self.parameters['first_page']['optional']
-                    else: 
-                        optional = True
-
-                    # Processs new url if found
-                    if url_new:
-                        url = self.parse_url(self.url, url_new)
-                        assert isinstance(url, str) and url, 'Error: Empty url provided for first page'
-                        # //TODO validate
-                        
-                        # Store cleaned news url as base url and get new request
-                        self.url = url
-                        self.soup = self.get_request('get', self.url)
-
-                    # If no new url yielded
-                    else:
-                        assert optional, 'Error: no url_new while non-optional, add parameter or verify'
 
-            # //TODO add post request logic
-            elif request_type  == 'post':
-                assert 'payload' in self.parameters.keys(), 'Error: no payload for post request'
-                self.soup = self.get_request('post', self.url, payload=self.parameters['payload'])
-                
+    def get_settings(self, key, defaults):
+        """
+        Returns settings dictionary for key. A routine's parameters over-ride 
+        "settings.json", which over-rides defaults.
+        """
+        settings = dict(defaults)
+        settings.update(self.settings.get(key, {}))
+        if hasattr(self, 'parameters'):
+            settings.update(self.parameters.get(key, {}))
+        return settings
 
-            # Iterate over pages to scrape until no "next_page" url yielded
-            while_continue = True
-            while while_continue:
-                    
-                # Iterate over functions and call them
-                for fc_name, fc_args in routine['functions'].items():
 
-                    # To support repetition of function, needs unique digit in name
-                    fc = ''.join([c for c in fc_name if not c.isnumeric()])
+    def get_bucket(self, url, settings):
+        """
+        Returns token bucket for url's host, shared by routines and paced by the strictest 
+        rate and burst any of them asked for.
+        """
+        host = urlsplit(url).netloc
+        assert settings['rate'] > 0 and settings['burst'] >= 1, "Error: limiter needs rate > 0 and burst >= 1"
 
-                    # Call function with arguments provided           
-                    getattr(self, fc)(fc_args)
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(settings['rate'], settings['burst'])
+            bucket = self.buckets[host]
 
-                # Keep looping while 'next_page' yields a new url 
-                if 'next_page' in self.parameters.keys():
-                    
+        # Only ever slowed down, never set back to a faster routine's pace
+        if settings['rate'] < bucket.rate or settings['burst'] < bucket.burst:
+            with bucket.lock:
+                bucket.rate = min(bucket.rate, settings['rate'])
+                bucket.burst = min(bucket.burst, settings['burst'])
+                bucket.tokens = min(bucket.tokens, bucket.burst)
 
-                    # Post request logic #//TODO fix/do
-                    if request_type == 'post':
-                        page_value = self.parameters['payload'][self.parameters['next_page']['payload']]
-                        next_page_value = page_value + 1
-                        if next_page_value > self.parameters['next_page']['max']:
-                            while_continue = False
-                            continue
-                        self.parameters['payload'][self.parameters['next_page']['payload']] = next_page_value
-                        self.soup = self.get_request('post', self.url, payload=self.parameters['payload'])
-
-                    # Get request logic
-
-                    elif "in_url" in self.parameters["next_page"].keys():
-                        params = list(map(int, params))
-                        if "quarter" in self.parameters["next_page"]["in_url"]:
-                            i_quarter = self.parameters["next_page"]["in_url"].index("quarter")
-                            if params[i_quarter] != 1 and params[i_quarter] <= 4:
-                                params[i_quarter] -= 1
-                            elif params[i_quarter] == 1:
-                                params[i_quarter] += 3
-                                i_year = self.parameters["next_page"]["in_url"].index("year")
-                                params[i_year] -= 1
-
-                        if params[i_year] <= self.parameters["next_page"]["end"][i_year]:
-                            while_continue = False
-                            break
-
-                        url = self.url % tuple(map(str, params))
-                        self.soup = self.get_request('get', url)
-    
+        return bucket
 
-                    elif request_type == 'get':
-
-                        # Convert to list (of len=1) if single dictionary
-                        if isinstance(self.parameters['next_page'], dict):
-                            self.parameters['next_page'] = [self.parameters['next_page']]
-                        
-                        # Get new url from every selection_dictionary provided, until non is yielded 
-                        for element_i, element_dic in enumerate(self.parameters['next_page']):
-                            
-                            # //TODO check logic
-                            if 'optional' in element_dic.keys():
-                                optional = element_dic['optional']
-                            else: 
-                                optional = False
-                            
-                            # Update url, //TODO merge with first_page and expand url parsing
-                            url_new = self.get_elements(element_dic)
-                            if url_new:
-                                url = self.parse_url(self.url, url_new)
-                                if url:
-                                    self.url = url
-                                    self.soup = self.get_request('get', self.url)
-                                    break
-                            elif not url_new and element_i == len(self.parameters['next_page']) - 1:
-                                #assert optional, 'Error: non-optional url_new empty in next_page'
-                                while_continue = False
-                
-                # Don't loop without 'next_page' instruction
-                else:
-                    while_continue = False
-                    
 
-    def check_argv(self, argv, demo=False):
+    def get_retry_after(self, response, attempt, settings):
         """
-        Parse CLI arguments provided and stores appropriate lists in 
-        storage attributes (self.scrape_files and self.scrape_routines)
+        Returns seconds to wait after a throttled response. Uses the server's 
+        Retry-After (seconds or http-date) if given, else exponential backoff.
         """
-        # Only first arg (files) provided
-        if len(argv) in [2]:
-            self.scrape_files = argv[1]
-            self.scrape_routines = []
-
-        # Both args provided
-        elif len(argv) in [3]:
-            self.scrape_files = argv[1]
-            self.scrape_routines = argv[2]
+        retry_after = response.headers.get('Retry-After', '').strip()
 
-        # No args provided, returns empty list
+        if retry_after.isdigit():
+            wait = int(retry_after)
+        elif retry_after:
+            try:
+                date = parsedate_to_datetime(retry_after)
+                wait = (date - datetime.now(tz=date.tzinfo)).total_seconds()
+            except (TypeError, ValueError):
+                wait = settings['backoff'] * 2 ** attempt
         else:
-            self.scrape_files = []
-            self.scrape_routines = []
-            return
-
-        # Converts str to list
-        if self.scrape_files and isinstance(self.scrape_files, str):
-            if len(self.scrape_files) > 1 and self.scrape_files[0] == ['['] and self.scrape_files[1] == [']'] :
-                self.scrape_files = eval(self.scrape_files)
-            else:
-                self.scrape_files = [self.scrape_files]
+            wait = settings['backoff'] * 2 ** attempt
 
-        # Converts str to list
-        if self.scrape_routines and isinstance(self.scrape_routines, str):
-            if len(self.scrape_routines) > 1 and self.scrape_routines[0] == ['['] and self.scrape_routines[1] == [']'] :
-                self.scrape_routines = eval(self.scrape_routines)
-            else:
-                self.scrape_routines = [self.scrape_routines]
+        return min(max(wait, 0), settings['max_backoff'])
 
 
-    def database_setup(self, db_type, db_settings=''):
+    def get_cache(self, settings):
         """
-        Initialize ways of outputting scraped data. 
-        Passing it a settings dictionary over-rides priority. 
+        Returns response cache of settings' folder, created on first use.
         """
-        assert db_type in ['sql', 'csv'], "Error: '" + db_type + "' for database not 'sql' or 'csv'"
+        with self.lock:
+            if settings['path'] not in self.caches:
+                self.caches[settings['path']] = ResponseCache(settings['path'], settings['max_size'])
+            return self.caches[settings['path']]
 
 
-        # //TODO check for prio?
-        if not db_settings:
-            db_settings = self.db_settings[db_type]
-
-        # Connect to SQL database
-        if db_type == 'sql':
-            try:
-                self.conn = psycopg2.connect(        
-                    host=db_settings['host'],
-                    database=db_settings['database'],
-                    user=db_settings['user'],
-                    password=db_settings['password']
-                )
-                
-                self.cur = self.conn.cursor()          
+    def get_session(self, url):
+        """
+        Returns pooled session for url's host, created on first request. Sessions keep 
+        connections alive between requests and retry failed connections.
+        """
+        host = urlsplit(url).netloc
 
-            except psycopg2.OperationalError as err:
-                err_arg = err.args[0].split('FATAL:  ')[1].split(' ')[0]
-                print("Couldn't connect to database: " + err_arg)
-                exit()
+        with self.lock:
+            if host not in self.sessions:
+                self.sessions[host] = self.new_session()
 
-        # Prepare folder and variables for .csv files to output
-        if db_type == 'csv':
-            pass #//todo implement
+        return self.sessions[host]
 
 
-    def get_request(self, type_req, url, payload='', headers='', limiter=2):
+    def new_session(self):
         """
-        Returns soup of requested url. Limits requests per second to limiter.
-        //TODO Add/finish post details, probably doesn't work ATM
+        Returns session with pool, retries and keep-alive from the routine's settings.
         """
-        assert type_req.lower() in ['get', 'post'], "Error: '" + type_req.lower() + "' request not 'get' or 'post'."
-        assert isinstance(url, str) and len(url) > 3 and '.' in url, "Error: invalid url '" + url + "'"
-        
-        # Read local files
-        if '.html' == url[-5:]:
-            with open(url, encoding='utf-8') as f:
-                soup = BeautifulSoup(f.read(), 'lxml')
+        settings = self.get_settings('session', SESSION_DEFAULTS)
 
-        else:
-            #//TODO CHeck up
-            if 'headers' in self.parameters.keys():
-                headers = self.parameters['headers']
-            else:
-                headers = {}
+        # Retry connection errors and server errors with exponential backoff
+        retries = Retry(
+            total=settings['retries'],
+            backoff_factor=settings['backoff'],
+            status_forcelist=[500, 502, 504],
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings['pool_size'], max_retries=retries)
 
-            # Max 1 request per limiter seconds
-            delta = datetime.now() - self.last_request
-            if delta.seconds < limiter:
-                time.sleep(2 - delta.total_seconds())
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not settings['keep_alive']:
+            session.headers['Connection'] = 'close'
 
-            # Payload for post
-            if isinstance(payload, dict):
-                response = getattr(requests, type_req.lower())(url, headers=headers, data=payload) #//todo VALIDATE
-            else:
-                response = getattr(requests, type_req.lower())(url, headers=headers)
+        # Cookies persist across the routine's requests
+        session.cookies = self.cookies
 
-            assert response.status_code == 200, "Error: Status code " + str(response.status_code) + " of request"
-            #//TODO add contingencies
+        return session
 
-            # Get requested soup
-            soup = BeautifulSoup(response.content, 'lxml') #//TODO save as pickle?
-        
-        return soup
 
+    def close_sessions(self):
+        """
+        Closes pooled sessions and their connections.
+        """
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
 
+
+    @timed('get_elements')
     def get_elements(self, element_dic, soup='', results=''):
         """
         Returns elements or values (attribute or text of elements). Searches within soup if provided, else from self.soup.
-        Results used for recursive search.. 
+        Selection dictionary is compiled on first call of the routine. Results are extended if provided.
         """
-
-        assert 'tag' in element_dic.keys() or 'attr' in element_dic.keys(), "Error: Mandatory 'tag' not found in 'get_elements()'s dic."
-        
         # Make results to empty list on first root function call
         if not isinstance(results, list):
             results = []
 
         # Assign base soup if none provided
-        if not soup:
+        if isinstance(soup, str):
             soup = self.soup
 
-        # Return elements if tag provided with attribute selector
-        if "tag" in element_dic.keys() and "type" in element_dic.keys() and "sel" in element_dic.keys():
-            tags = soup.find_all(element_dic['tag'], {element_dic['type']: element_dic['sel']})
-        
-        # Return elements if tag provided alone
-        elif "tag" in element_dic.keys():
-            tags = soup.find_all(element_dic['tag'])
-
-        # Return soup as single tag otherwise //TODO for what alrdy?
-        else:
-            tags = [soup]
-
-        # Slice tags by index if provided
-        if "index" in element_dic.keys():
-            assert isinstance(element_dic['index'], int) or isinstance(element_dic['index'], list), "Error: index not int or list not found in 'get_elements()'s dic."
-
-            # Get single tag in list
-            if isinstance(element_dic['index'], int):
-                tags = [tags[element_dic['index']]]
-
-            # Get range of tags in list
-            elif isinstance(element_dic['index'], list):
-                assert len(element_dic['index']) == 2, "Error: index list not with 2 values [min, max]."
-                tags = tags[element_dic['index'][0]:element_dic['index'][1]]
+        # Values found by worker process
+        if isinstance(soup, PageValues):
+            results.extend(soup.elements[PageExtraction.key(element_dic)])
+            return results
 
-        # Iterate over tags
-        for tag in tags:
-
-            # If 'child' present, recursively call present function.
-            # Will push results from deepest node/child to root function call
-            if 'child' in element_dic.keys():
-                results = self.get_elements(element_dic['child'], soup=tag, results=results)
-                break
+        results.extend(self.get_selector(element_dic).select(soup))
+        return results
 
-            # Return text or attribute if requested
-            elif 'attr' in element_dic.keys():
-                if 'text' == element_dic['attr']:
-                    result = tag.text
-                else:
-                    result = tag[element_dic['attr']]
 
-            # Return original tag otherwise
-            else:
-                result = tag
+    def get_selector(self, element_dic, compiler=Selector):
+        """
+        Returns dictionary compiled by compiler (Selector or ValueTrie), from routine if compiled 
+        along it, else compiled on first use and cached for the routine.
+        """
+        key = (id(element_dic), compiler)
+        if key not in self.selectors:
 
-            # Return result (if str) sliced
-            if 'slice' in element_dic.keys():
-                assert isinstance(result, str), 'Error: Tried to slice non-str'
-                result = result[element_dic['slice'][0]:element_dic['slice'][1]]
-            
-            # Returns result re-interpreted by 'date_type' format string
-            if "date_type" in element_dic.keys():
-                assert isinstance(result, str), "Error: date to parse is'" + type(result) + "' not str."
-                result = datetime.strptime(result.strip(), element_dic['date_type'])
-            
-            # Add processed tag to results
-            results.append(result)
+            # Dictionary kept with its selector so its id isn't reused
+            self.selectors[key] = (element_dic, compiler(element_dic))
 
-        # Returns results (to itself or root call)
-        return results
+        return self.selectors[key][1]
 
 
     def parse_url(self, url, url_new):
@@ -485,6 +2841,84 @@ class ScrapeControl:
         """
         Locally downloads provided url under provided file_name
         """
+        url, filename = self.download_target(dic, results)
+        self.save_page(url, filename)
+
+
+    @timed('save_page')
+    def save_page(self, url, filename):
+        """
+        Saves page of url under filename in path_out. The bytes received are streamed 
+        to file by chunks, compressed if requested, without parsing the page.
+        """
+        compression = self.get_settings('download', DOWNLOAD_DEFAULTS)['compression']
+        assert compression in ['', 'gzip', 'zstd'], "Error: compression '" + compression + "' not '', 'gzip' or 'zstd'"
+        assert compression != 'zstd' or zstandard, "Error: 'zstandard' is required for zstd compression"
+
+        # Retrieve page bytes
+        chunks = self.get_content('get', url, stream=True)
+
+        # Locally save page, renamed once complete
+        assert self.path_out, "Error: no 'path_out' for downloaded pages"
+        file_name = self.path_out + filename + {'': '', 'gzip': '.gz', 'zstd': '.zst'}[compression]
+        temp_name = file_name + '.' + str(threading.get_ident()) + '.tmp'
+
+        if compression == 'gzip':
+            f = gzip.open(temp_name, 'wb')
+        elif compression == 'zstd':
+            f = zstandard.ZstdCompressor().stream_writer(open(temp_name, 'wb'))
+        else:
+            f = open(temp_name, 'wb')
+
+        try:
+            with f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+        os.replace(temp_name, file_name)
+
+
+    def queue_download(self, dic, results=''):
+        """
+        Queues download of provided url to background workers, downloaded inline without workers.
+        """
+        self.submit_download(*self.download_target(dic, results))
+
+
+    def submit_download(self, url, filename):
+        """
+        Queues download of url under filename, downloaded inline without workers.
+        """
+        settings = self.get_settings('download', DOWNLOAD_DEFAULTS)
+        if not settings['workers']:
+            return self.save_page(url, filename)
+
+        if not self.downloads:
+            self.downloads = DownloadQueue(self.save_page, settings)
+        self.downloads.submit(url, filename)
+
+
+    def join_downloads(self):
+        """
+        Waits for queued downloads of routine and prints their report.
+        """
+        if not self.downloads:
+            return
+
+        report = self.downloads.join()
+        self.downloads = None
+        print('Downloaded: ' + str(report['done']) + ' pages, ' + str(len(report['failed'])) + ' failed')
+        for url, error in report['failed']:
+            print('Failed download: ' + url + ' (' + error + ')')
+        return report
+
+
+    def download_target(self, dic, results=''):
+        """
+        Returns url and file name to download, from provided values or referenced fields.
+        """
         #//todo unnecessary?
         dic = dic.copy()
 
@@ -492,52 +2926,49 @@ class ScrapeControl:
         for key in ['url', 'file_name']:
             if isinstance(dic[key], str) and dic[key][0] == '.':
                 dic[key] = results[dic[key][1:]]
-            
-        # Retrieve page soup
-        url = self.parse_url(self.url, url_new=dic['url'])
-        soup = self.get_request('get', url)
 
-        # Locally save page
+        url = self.parse_url(self.url, url_new=dic['url'])
         filename = str(dic['file_name']) + ".html"
-        with open(self.parameters['path_out'] + filename, 'w',  encoding="utf-8") as f:            
-            f.write(str(soup))
+        return url, filename
 
 
     def scrape_values(self, dic):
         """
-        Retrieves requested values to local dictionary
+        Retrieves requested values of every container to local dictionary
         """
         assert isinstance(dic, dict), "Error: " + type(dic) + " provided to 'scrape_values()' instead of dict"
         
-        # //todo maybe unnecessary
-        dic = dic.copy()
-
-        # Retrieving containers
-        containers = self.get_elements(dic['containers'])
-        assert containers, 'Error: no containers'
-        del dic['containers']
-
-        # We'll iterate over containers and dump results in self.scrape_results under it's container id
-        self.scrape_results = {}
-        for container_i, container in enumerate(containers):
-            self.scrape_results[container_i] = {}
-
-            # Get values requested
-            for value_name, element_dic in dic['values'].items():
-
-                # Adds current count to len of present table //todo implement
-                if element_dic == 'serial':
-                    self.scrape_results[container_i][value_name] = container_i
+        # Values by container found by worker process in pipeline mode
+        if isinstance(self.soup, PageValues):
+            self.scrape_results = dict(self.soup.values[PageExtraction.key(dic)])
 
-                # Returns requested elements
+        else:
+            # Retrieving containers
+            containers = self.get_elements(dic['containers'])
+            assert containers, 'Error: no containers'
+
+            # We'll iterate over containers and dump results in self.scrape_results under it's container id,
+            # every value found in a single pass over the container
+            values = self.get_selector(dic['values'], compiler=ValueTrie)
+            self.scrape_results = {}
+            for container_i, container in enumerate(containers):
+                self.scrape_results[container_i] = values.extract(container, container_i)
+
+        # Skip records already seen by incremental routine, page entirely known if none is new
+        key = self.get_settings('incremental', INCREMENTAL_DEFAULTS)['key']
+        if self.seen is not None and key in dic['values'].keys():
+            for container_i, row in list(self.scrape_results.items()):
+                if not row[key]:
+                    continue
+                value = self.seen_key(row[key])
+                if value in self.seen:
+                    del self.scrape_results[container_i]
                 else:
-                    assert isinstance(element_dic, dict), "Error: " + type(element_dic) + " provided to 'scrape_values()' instead of dict"
-                    results = self.get_elements(element_dic, soup=container)
-                    if isinstance(results, list) and len(results) == 1: #//TODO check ==1
-                        results = results[0]
+                    self.seen.add(value)
+                    self.new_seen.append(value)
 
-                    # Stores results
-                    self.scrape_results[container_i][value_name] = results
+            if not self.scrape_results:
+                self.page_known = True
 
 
     def entry_to_db(self, dic):
@@ -547,80 +2978,335 @@ class ScrapeControl:
         assert isinstance(dic, dict), "Error: " + type(dic) + " provided to 'entry_to_db()' instead of dict"
         #//todo validation
 
-        # Logic for sql
-        if self.parameters['database'] == 'sql':
-            
-            # Get table and length
-            table = dic['table'] 
-            self.cur.execute('SELECT * from ' + table + ';')
-            table_len = len(self.cur.fetchall())
-
-            # Increment serial count to table's length
-            if "serial" in dic.keys():
-                if isinstance(dic['serial'], str):
-                    dic['serial'] = [dic['serial']]
+        # Output type from routine's database, else function or settings
+        table = dic['table']
+        db_type = self.parameters.get('database', dic.get('type', self.db_type))
+        assert db_type in ['sql', 'csv'], "Error: '" + db_type + "' for database not 'sql' or 'csv'"
+        assert db_type != 'sql' or self.conn is not None or self.emitted is not None, "Error: table '" + table + "' written to sql but routine's database is '" + self.db_type + "'"
+
+        serial_fields = dic.get('serial', [])
+        if isinstance(serial_fields, str):
+            serial_fields = [serial_fields]
+
+        # Rows upserted on natural keys, with hash of their content. Keys already in table keep their serials
+        upsert = dic.get('upsert', [])
+        if isinstance(upsert, str):
+            upsert = [upsert]
+        upsert = upsert if self.emitted is None else []
+        if upsert:
+            assert db_type == 'sql', "Error: 'upsert' of table '" + table + "' needs an sql database"
+            hash_field = dic.get('hash', 'row_hash')
+            hashes = self.load_hashes(table, upsert, serial_fields, hash_field)
+            self.upserts[table] = (upsert, serial_fields)
+            keys = [tuple(str(self.field_value(field, dic['fields'][field], entry_dic)) for field in upsert) for entry_dic in self.scrape_results.values()]
+            new_keys = list(dict.fromkeys(key for key in keys if key not in hashes))
+
+        # Serial fields continue from table's last value, for new keys only when upserting
+        count = len(new_keys) if upsert else len(self.scrape_results)
+        serials = {field: self.allocate_serials(db_type, table, field, count) for field in serial_fields}
+        if upsert:
+            new_serials = {key: {field: values[i] for field, values in serials.items()} for i, key in enumerate(new_keys)}
+            entry_serials = [hashes[key][1] if key in hashes else new_serials[key] for key in keys]
+        else:
+            entry_serials = [{field: values[i] for field, values in serials.items()} for i in range(count)]
+        
+        # Iterate over entries 
+        for position, (entry_i, entry_dic) in enumerate(self.scrape_results.items()):
+            #//TODO implement logic for nested vars, query vars
+
+            # Iterate over requested fields
+            row = {}
+            for field, value in dic['fields'].items():
+
+                # Serial of entry
+                if field in serial_fields:
+                    value = entry_serials[position][field]
+                    self.scrape_results[entry_i][dic['fields'][field][1:]] = value
+                else:
+                    value = self.field_value(field, value, entry_dic)
+
+                row[field] = value
+
+            # Upserted rows unchanged since last written are skipped
+            if upsert:
+                key = keys[position]
+                row[hash_field] = hashlib.sha256(json.dumps([value for field, value in row.items() if field not in serial_fields], default=str).encode('utf-8')).hexdigest()
+                if key in hashes and hashes[key][0] == row[hash_field]:
+                    self.metrics.count('unchanged')
+                    continue
+                hashes[key] = (row[hash_field], entry_serials[position])
+
+            # Add row to batch, or to rows of page for iter_rows
+            self.metrics.count('rows')
+            if self.emitted is not None:
+                self.emitted.append(row)
             else:
-                dic['serial'] = []
+                self.queue_row(db_type, table, row)
             
-            # Iterate over entries 
-            for entry_i, entry_dic in self.scrape_results.items():
-                #//TODO implement logic for nested vars, query vars
-
-                # Iterate over requested fields
-                fields = []
-                values = []
-                for field, value in dic['fields'].items():
-
-                    # Null values
-                    if isinstance(value, str) and not value:
-                        value = 'NULL'
-
-                    # Stored variable //todo add multi-level capability
-                    elif isinstance(value, str) and value[0] == '.':
-                        value = entry_dic[value[1:]]
-
-                    # Convert datetime field to sql-readable date
-                    if isinstance(value, datetime):
-                        value = datetime.strftime(value, '%Y-%m-%d')
-
-                    # Increment serial count to table's length
-                    if field in dic['serial']:
-                        value = int(value) + table_len + 1
-                        self.scrape_results[entry_i][dic['fields'][field][1:]] = value
-
-                    # Format numbers as str for sql query
-                    if isinstance(value, int) or isinstance(value, float) or isinstance(value, str) and value.isnumeric():
-                        value = str(value)
-
-                    # Format values requiring apostrophes for sql 
-                    elif isinstance(value, str) and value != 'NULL':
-                        if field in ['href', 'url']:
-                            value = self.parse_url(self.url, value)
-                        value = value.strip()
-                        value = value.replace("'", ' ')
-                        value = "'" + value + "'"
-                    
-                    # To list for forming query
-                    fields.append(field)
-                    values.append(value)
-
-                # To comma-separated string for query
-                fields = ', '.join(fields)
-                values = ', '.join(values)
-
-                # Execute insertion query
-                sql = 'INSERT INTO ' + table + ' (' + fields + ') VALUES (' + values + ');'
-                self.cur.execute(sql)
-                self.conn.commit()
-                #//todo implement error controls
-                
-                # Download url locally if requested
-                if 'download_entry' in self.parameters.keys():
-                    self.download_page(self.parameters['download_entry'], results=entry_dic)
+            # Queue download of url if requested
+            if 'download_entry' in self.parameters.keys():
+                self.queue_download(self.parameters['download_entry'], entry_dic)
 
-        # Logic for csv //TODO implement
-        if self.parameters['database'] == 'csv':
-            pass
+        # One transaction per page unless batching over pages
+        if not self.get_settings('writer', WRITER_DEFAULTS)['batch_size']:
+            self.flush_rows()
+
+
+    def field_value(self, field, value, entry_dic):
+        """
+        Returns value of field for entry, from stored variable if value is '.' and its name.
+        """
+        # Null values
+        if isinstance(value, str) and not value:
+            value = None
+
+        # Stored variable //todo add multi-level capability
+        elif isinstance(value, str) and value[0] == '.':
+            value = entry_dic[value[1:]]
+
+        # Convert datetime field to sql date
+        if isinstance(value, datetime):
+            value = value.date()
+
+        # Clean text values, escaped by the database driver
+        elif isinstance(value, str):
+            if field in ['href', 'url']:
+                value = self.parse_url(self.url, value)
+            value = value.strip()
+
+        return value
+
+
+    def allocate_serials(self, db_type, table, field, count):
+        """
+        Returns next count values of table's serial field. The field's MAX is read once 
+        per launch then counted locally, by a counter of the output shared by workers, or 
+        values are drawn from the column's sequence with the 'sequence' serial setting when 
+        other writers share the table. Files count from their number of rows.
+        """
+        if db_type == 'sql' and self.get_settings('writer', WRITER_DEFAULTS)['serial'] == 'sequence':
+            with self.write_lock:
+                self.cur.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s);', (table, field, count))
+                return [value for value, in self.cur.fetchall()]
+
+        # Outputs told apart by folder of files or database settings
+        if db_type == 'csv':
+            sink = self.get_sink(table)
+            key = (db_type, sink.path, table, field)
+        else:
+            key = (db_type, json.dumps(self.database.db_settings, sort_keys=True, default=str), table, field)
+
+        with self.serial_lock:
+            if key not in self.serials and db_type == 'csv':
+                self.serials[key] = sink.count_rows()
+            elif key not in self.serials:
+                with self.write_lock:
+                    self.cur.execute('SELECT COALESCE(MAX(' + field + '), 0) FROM ' + table + ';')
+                    self.serials[key] = self.cur.fetchone()[0]
+
+            first = self.serials[key] + 1
+            self.serials[key] += count
+        return list(range(first, first + count))
+
+
+    def load_hashes(self, table, keys, serial_fields, hash_field):
+        """
+        Returns content hash and serials (dict by field) of table's rows by natural key (tuple 
+        of keys' values as str), read once per routine and updated as rows are queued.
+        """
+        if table not in self.hashes:
+            with self.write_lock:
+                self.cur.execute('SELECT ' + ', '.join(list(keys) + list(serial_fields) + [hash_field]) + ' FROM ' + table + ';')
+                self.hashes[table] = {
+                    tuple(str(value) for value in row[:len(keys)]): (row[-1], dict(zip(serial_fields, row[len(keys):-1])))
+                    for row in self.cur.fetchall()
+                }
+        return self.hashes[table]
+
+
+    def conflict_clause(self, table, fields):
+        """
+        Returns ON CONFLICT clause updating fields of upserted table but its keys and serials, '' for others.
+        """
+        if table not in self.upserts:
+            return ''
+        keys, serial_fields = self.upserts[table]
+        updates = [field for field in fields if field not in keys and field not in serial_fields]
+        if not updates:
+            return ' ON CONFLICT (' + ', '.join(keys) + ') DO NOTHING'
+        return ' ON CONFLICT (' + ', '.join(keys) + ') DO UPDATE SET ' + ', '.join(field + ' = EXCLUDED.' + field for field in updates)
+
+
+    def queue_row(self, db_type, table, row):
+        """
+        Adds row (dict of field: value) to table's batch, written once batch_size rows are pending.
+        """
+        key = (db_type, table, tuple(row.keys()))
+        self.pending_rows.setdefault(key, []).append(tuple(row.values()))
+        self.pending_count += 1
+
+        batch_size = self.get_settings('writer', WRITER_DEFAULTS)['batch_size']
+        if batch_size and self.pending_count >= batch_size:
+            self.flush_rows()
+
+
+    @timed('flush')
+    def flush_rows(self):
+        """
+        Writes pending rows as a batch, or hands it to the writer stage with 'threads' writer 
+        setting, waiting while its queue is full.
+        """
+        if not self.pending_rows:
+            return
+
+        settings = self.get_settings('writer', WRITER_DEFAULTS)
+        assert settings['method'] in ['values', 'copy'], "Error: writer method '" + settings['method'] + "' not 'values' or 'copy'"
+
+        pending_rows = self.pending_rows
+        self.pending_rows = {}
+        self.pending_count = 0
+
+        # Writer stage started on first batch of routine, batch holds every row of pages up to checkpoint
+        if settings['threads']:
+            if not self.writer:
+                self.writer = RowWriter(self.write_batch, self.ack_batch, settings)
+            self.writer.submit(pending_rows, self.checkpoint)
+            return
+
+        self.write_batch(pending_rows)
+        self.ack_batch(pending_rows, self.checkpoint)
+
+
+    @timed('write')
+    def write_batch(self, pending_rows):
+        """
+        Writes rows by (db_type, table, fields) to files, and to database in a single transaction 
+        with parameterized multi-row inserts or COPY FROM STDIN.
+        """
+        # Files are appended to table by table
+        for (db_type, table, fields), rows in pending_rows.items():
+            if db_type == 'csv':
+                sink = self.get_sink(table)
+                with sink.lock:
+                    sink.write(fields, rows)
+
+        pending_rows = {key: rows for key, rows in pending_rows.items() if key[0] == 'sql'}
+        if not pending_rows:
+            return
+
+        # Batch written again on a new connection if the database dropped it
+        settings = self.get_settings('writer', WRITER_DEFAULTS)
+        with self.write_lock:
+            try:
+                self.write_rows(pending_rows, settings)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if not self.conn.closed:
+                    raise
+                self.reconnect()
+                self.write_rows(pending_rows, settings)
+
+
+    def ack_batch(self, pending_rows, checkpoint=None, seen=()):
+        """
+        Counts rows of batch written, then stores keys seen and checkpoint of pages entirely 
+        written, as captured when the batch was submitted.
+        """
+        self.rows_written += sum(len(rows) for rows in pending_rows.values())
+        self.save_seen(list(seen))
+        if checkpoint:
+            self.save_checkpoint(checkpoint)
+
+
+    def join_writer(self):
+        """
+        Waits for batches queued to writer stage to be written and acknowledged, raising a write error.
+        """
+        if self.writer:
+            writer, self.writer = self.writer, None
+            writer.join()
+
+
+    def write_rows(self, pending_rows, settings):
+        """
+        Writes rows by (db_type, table, fields) to database in a single transaction, rolled back on error.
+        """
+        try:
+            for (db_type, table, fields), rows in pending_rows.items():
+
+                # Upserted rows of a key written once per batch, last one kept
+                conflict = self.conflict_clause(table, fields)
+                if conflict:
+                    positions = [fields.index(key) for key in self.upserts[table][0]]
+                    rows = list({tuple(row[i] for i in positions): row for row in rows}.values())
+
+                # Stream rows as csv, \N standing for NULL. Upserted rows are copied to a 
+                # temporary table, then inserted from it
+                if settings['method'] == 'copy':
+                    target = 'upsert_' + table.replace('.', '_') if conflict else table
+                    if conflict:
+                        self.cur.execute('CREATE TEMP TABLE ' + target + ' AS SELECT ' + ', '.join(fields) + ' FROM ' + table + ' WITH NO DATA;')
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    writer.writerows([['\\N' if value is None else value for value in row] for row in rows])
+                    buffer.seek(0)
+                    self.cur.copy_expert(
+                        'COPY ' + target + ' (' + ', '.join(fields) + ") FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                        buffer
+                    )
+                    if conflict:
+                        self.cur.execute('INSERT INTO ' + table + ' (' + ', '.join(fields) + ') SELECT ' + ', '.join(fields) + ' FROM ' + target + conflict + ';')
+                        self.cur.execute('DROP TABLE ' + target + ';')
+
+                # Multi-row insert, values escaped by psycopg2
+                else:
+                    execute_values(
+                        self.cur,
+                        'INSERT INTO ' + table + ' (' + ', '.join(fields) + ') VALUES %s' + conflict,
+                        rows,
+                        page_size=settings['page_size']
+                    )
+
+            self.conn.commit()
+
+        except psycopg2.Error:
+            if not self.conn.closed:
+                self.conn.rollback()
+            raise
+
+
+    def get_sink(self, table):
+        """
+        Returns file output for table, created on first use.
+        """
+        with self.lock:
+            if table not in self.sinks:
+                self.sinks[table] = FileSink(table, self.file_settings or self.get_settings('csv', FILE_DEFAULTS))
+            return self.sinks[table]
+
+
+    def close_sinks(self):
+        """
+        Writes buffered rows and closes file outputs.
+        """
+        for sink in self.sinks.values():
+            sink.flush()
+            sink.close()
+        self.sinks = {}
+
+
+def run_routine(name, routine, engine, resume):
+    """
+    Runs routine on an instance of its own, in a worker process of the scheduler.
+    """
+    ctrl = ScrapeControl()
+    ctrl.engine = engine
+    ctrl.resume = resume
+    try:
+        ctrl.run(routine, name)
+    finally:
+        ctrl.close_sessions()
+        ctrl.close_pools()
+        ctrl.close_databases()
 
 
 # Execute when file launched, passes on arguments
@@ -1,12 +1,25 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 import psycopg2
 import time
 import os
 from datetime import datetime
+from urllib.parse import urlsplit
 import json
 import sys
 
+
+# Defaults for pooled sessions, over-ridden by "session" in settings file or in a routine's parameters
+SESSION_DEFAULTS = {
+    'pool_size': 10,
+    'retries': 3,
+    'backoff': 0.5,
+    'keep_alive': True,
+    'timeout': 30
+}
+
 class ScrapeControl:
     def __init__(self):
         """
@@ -24,12 +37,17 @@ class ScrapeControl:
         # To monitor request load
         self.last_request = datetime.now()
 
+        # Pooled sessions per host and cookie jar shared by a routine's sessions
+        self.sessions = {}
+        self.cookies = requests.cookies.RequestsCookieJar()
+
         # Load output settings from mandatory file
         try:
             with open(self.path_jobs + "database_settings.json", "r") as f:
                 self.db_settings = json.load(f)
         except FileNotFoundError:
             assert False, 'Error: file not found "scrape/settings.json".'
+        self.settings = self.db_settings
         
 
     def launch(self, files='', routines='', argv=''):
@@ -82,6 +100,8 @@ class ScrapeControl:
                 print('Running: ' + name)
                 self.run(routine, name)
 
+        # Release pooled connections
+        self.close_sessions()
 
 
     def run(self, routine, routine_name):
@@ -92,6 +112,11 @@ class ScrapeControl:
         assert 'parameters' in routine.keys(), "Error: parameters dict not found in rountine."
         self.parameters = routine['parameters']
 
+        # Fresh cookie jar for the routine, shared by every pooled session
+        self.cookies = requests.cookies.RequestsCookieJar()
+        for session in self.sessions.values():
+            session.cookies = self.cookies
+
         # Verify inputs in parameters
         for mandatory_parameter in ['url']:
             assert mandatory_parameter in self.parameters.keys(), "Error: '" + mandatory_parameter + "' not found in dict's parameters."
@@ -322,11 +347,13 @@ class ScrapeControl:
             if delta.seconds < limiter:
                 time.sleep(2 - delta.total_seconds())
 
-            # Payload for post
+            # Payload for post, sent over the host's pooled session
+            session = self.get_session(url)
+            timeout = self.get_settings('session', SESSION_DEFAULTS)['timeout']
             if isinstance(payload, dict):
-                response = getattr(requests, type_req.lower())(url, headers=headers, data=payload) #//todo VALIDATE
+                response = session.request(type_req.upper(), url, headers=headers, data=payload, timeout=timeout) #//todo VALIDATE
             else:
-                response = getattr(requests, type_req.lower())(url, headers=headers)
+                response = session.request(type_req.upper(), url, headers=headers, timeout=timeout)
 
             assert response.status_code == 200, "Error: Status code " + str(response.status_code) + " of request"
             #//TODO add contingencies
@@ -337,6 +364,59 @@ class ScrapeControl:
         return soup
 
 
+    def get_settings(self, key, defaults):
+        """
+        Returns settings dictionary for key. A routine's parameters over-ride 
+        the settings file, which over-rides defaults.
+        """
+        settings = dict(defaults)
+        settings.update(self.settings.get(key, {}))
+        if hasattr(self, 'parameters'):
+            settings.update(self.parameters.get(key, {}))
+        return settings
+
+
+    def get_session(self, url):
+        """
+        Returns pooled session for url's host, created on first request. Sessions keep 
+        connections alive between requests and retry failed connections.
+        """
+        host = urlsplit(url).netloc
+
+        if host not in self.sessions:
+            settings = self.get_settings('session', SESSION_DEFAULTS)
+
+            # Retry connection errors and server errors with exponential backoff
+            retries = Retry(
+                total=settings['retries'],
+                backoff_factor=settings['backoff'],
+                status_forcelist=[500, 502, 503, 504],
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings['pool_size'], max_retries=retries)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if not settings['keep_alive']:
+                session.headers['Connection'] = 'close'
+
+            # Cookies persist across the routine's requests
+            session.cookies = self.cookies
+            self.sessions[host] = session
+
+        return self.sessions[host]
+
+
+    def close_sessions(self):
+        """
+        Closes pooled sessions and their connections.
+        """
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+
+
     def get_elements(self, element_dic, soup='', results=''):
         """
         Returns elements or values (attribute or text of elements). Searches within soup if provided, else from self.soup.